@@ -7,19 +7,122 @@
 # @section authors Author(s)
 # - Created by Fabian Hickert on december 2020
 #
-from Utils import get_config
-from os import listdir, makedirs
+from Utils import get_config, get_extract_size
+from os import listdir, makedirs, environ
 from os.path import isfile, join, exists
 from datetime import datetime
 import cv2
+import numpy as np
 import time
 import queue
 import multiprocessing
 import logging
 from BeeProcess import BeeProcess
+from SharedImageQueue import SharedImageQueue
 
 logger = logging.getLogger(__name__)
 
+# The labels in the order of the network outputs
+LABELS = ["varroa", "pollen", "wasps", "cooling"]
+
+def _load_test_batches(batch_shape):
+    """! Loads the images from the "Images" folder and returns them as batches
+    @param batch_shape  The shape of the batches (batch_size, height, width, channels)
+    @return A list of BGR batches, the last one is padded with zeros
+    """
+    batch_size, img_height, img_width, _ = batch_shape
+    test_images = [join("Images", f) for f in sorted(listdir("Images")) if isfile(join("Images", f))]
+    batches = []
+    for num in range(0, len(test_images), batch_size):
+        batch = np.zeros(batch_shape, dtype=np.uint8)
+        for pos, item in enumerate(test_images[num:num+batch_size]):
+            batch[pos] = cv2.resize(cv2.imread(item), (img_width, img_height))
+        batches.append(batch)
+    return batches
+
+def _load_trt_model(batch_shape):
+    """! Returns the TensorRT optimized model. On first use the model from 'NN_MODEL_FOLDER'
+         gets converted and stored to 'NN_TENSORRT_FOLDER', as this may take several minutes.
+    @param batch_shape  The shape of the batches fed to the network
+    @return A function that runs the network on a batch of RGB images
+    """
+    import tensorflow as tf
+    from tensorflow.python.compiler.tensorrt import trt_convert as trt
+
+    trt_path = get_config("NN_TENSORRT_FOLDER")
+    if not exists(trt_path):
+        precision = get_config("NN_TENSORRT_PRECISION")
+        logger.info("Converting model to TensorRT (%s), this may take several minutes" % (precision,))
+
+        # The test images are used to build the engine and to calibrate INT8 ranges
+        def input_fn():
+            for batch in _load_test_batches(batch_shape):
+                yield (tf.reverse(tf.cast(batch, tf.float32), axis=[-1]),)
+
+        params = trt.TrtConversionParams(precision_mode=precision, maximum_cached_engines=1,
+                use_calibration=(precision == "INT8"))
+        converter = trt.TrtGraphConverterV2(input_saved_model_dir=get_config("NN_MODEL_FOLDER"),
+                conversion_params=params)
+        if precision == "INT8":
+            converter.convert(calibration_input_fn=input_fn)
+        else:
+            converter.convert()
+        converter.build(input_fn=input_fn)
+        converter.save(trt_path)
+
+    model = tf.saved_model.load(trt_path)
+    serve = model.signatures["serving_default"]
+    input_name = list(serve.structured_input_signature[1].keys())[0]
+
+    def forward(batch):
+        outputs = model.signatures["serving_default"](**{input_name: batch})
+        return [outputs[lbl + "_output"] for lbl in LABELS]
+    return forward
+
+def _load_tflite_model(batch_shape):
+    """! Returns the INT8 quantized TensorFlow Lite model. On first use the model from
+         'NN_MODEL_FOLDER' gets converted and stored to 'NN_TFLITE_FILE'.
+    @param batch_shape  The shape of the batches fed to the network
+    @return A function that runs the network on a batch of BGR images
+    """
+    import tensorflow as tf
+
+    tflite_path = get_config("NN_TFLITE_FILE")
+    if not exists(tflite_path):
+        logger.info("Converting model to TensorFlow Lite (INT8), this may take several minutes")
+
+        # The test images are used to calibrate the INT8 ranges, padded images are skipped
+        def representative_dataset():
+            for batch in _load_test_batches(batch_shape):
+                for img in batch:
+                    if img.any():
+                        yield [np.float32(img[np.newaxis, :, :, ::-1])]
+
+        converter = tf.lite.TFLiteConverter.from_saved_model(get_config("NN_MODEL_FOLDER"))
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        with open(tflite_path, "wb") as f:
+            f.write(converter.convert())
+
+    # Run the model on an accelerator, e.g. the EdgeTPU or the GPU, if a delegate is configured
+    delegates = []
+    delegate_lib = get_config("NN_TFLITE_DELEGATE")
+    if delegate_lib:
+        logger.info("Loading TensorFlow Lite delegate '%s'", delegate_lib)
+        delegates.append(tf.lite.experimental.load_delegate(delegate_lib))
+
+    interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=2,
+                                      experimental_delegates=delegates)
+    serve = interpreter.get_signature_runner("serving_default")
+    input_name = interpreter.get_signature_list()["serving_default"]["inputs"][0]
+
+    # The input and output stay float, the quantization happens within the model
+    def forward(batch):
+        outputs = serve(**{input_name: np.float32(batch[..., ::-1])})
+        return [outputs[lbl + "_output"] for lbl in LABELS]
+    return forward
+
 class BeeClassification(BeeProcess):
     """! The 'BeeClassification' class provides access to the neural network
           which runs in a seperate process. It provides two queue-objects,
@@ -34,11 +137,12 @@ class BeeClassification(BeeProcess):
         super().__init__()
 
         # reports when the porcess with the neural network is ready
-        self._ready = multiprocessing.Value('i', 0)
+        self._ready = multiprocessing.Event()
         self.set_process_param("ready", self._ready)
 
-        # The queue for the incoming images
-        self._q_in = multiprocessing.Queue(maxsize=20)
+        # The queue for the incoming images, the images are passed using shared memory
+        w, h = get_extract_size()
+        self._q_in = SharedImageQueue(maxsize=20, shape=(h, w, 3))
         self.set_process_param("q_in", self._q_in)
 
         ## The queue where the results are reported
@@ -47,11 +151,16 @@ class BeeClassification(BeeProcess):
 
         # Start the process and wait for it to run
         self.start()
-        while self._ready.value == 0:
-            time.sleep(5)
+        while not self._ready.wait(timeout=5) and not self.isDone():
             logger.info("Waiting for neural network, this may take up to two minutes")
         logger.debug("Classification terminated")
 
+    def stop(self):
+        """! Stops the process and releases the shared memory of the incoming queue
+        """
+        super().stop()
+        self._q_in.unlink()
+
     def getQueue(self):
         """! Returns the queue-object for the icoming queue
         @return  Returns the incoming queue object
@@ -69,6 +178,19 @@ class BeeClassification(BeeProcess):
         """! Static method, starts a new process that runs the neural network
         """
 
+        # Dedicate a small thread pool to launch the GPU kernels, this avoids that
+        # the kernel launches compete for the CPU with the other processes
+        environ["TF_GPU_THREAD_MODE"] = "gpu_private"
+        environ["TF_GPU_THREAD_COUNT"] = "2"
+
+        # Store the XLA compiled forward pass on disk, so it can be reused on the next start
+        xla_cache = get_config("NN_XLA_CACHE_FOLDER")
+        xla_cached = exists(xla_cache) and len(listdir(xla_cache)) > 0
+        if not exists(xla_cache):
+            makedirs(xla_cache)
+        environ["TF_XLA_FLAGS"] = (environ.get("TF_XLA_FLAGS", "") + \
+                " --tf_xla_persistent_cache_directory=" + xla_cache).strip()
+
         # Include tensorflow within the process
         import tensorflow as tf
         from tensorflow import keras
@@ -79,21 +201,14 @@ class BeeClassification(BeeProcess):
         _process_time = 0
         _process_cnt = 0
 
-        # Enable growth of GPU usage
-        config = tf.compat.v1.ConfigProto()
-        config.gpu_options.allow_growth = True
-        config.gpu_options.per_process_gpu_memory_fraction = 0.75  # added to limit GPU memory usage
-        session = tf.compat.v1.InteractiveSession(config=config)
-
-        # Load the model
-        try:
-            _model = tf.keras.models.load_model(get_config("NN_MODEL_FOLDER"))
-            _model.trainable = False
-        except Exception as e:
-            ready.value = True
-            logger.error("Failed to load Model: %s" % (e,))
-            return
-
+        # Only use the first GPU and enable growth of GPU usage.
+        # The CPU is only used to dispatch work to the GPU, so keep its thread pools small
+        gpus = tf.config.list_physical_devices("GPU")
+        if gpus:
+            tf.config.set_visible_devices(gpus[0], "GPU")
+            tf.config.experimental.set_memory_growth(gpus[0], True)
+            tf.config.threading.set_inter_op_parallelism_threads(1)
+            tf.config.threading.set_intra_op_parallelism_threads(2)
 
         # Detect desired image size for classification
         img_height = 300
@@ -102,98 +217,159 @@ class BeeClassification(BeeProcess):
             img_height = 150
             img_width = 75
 
+        # The network is always fed with batches of the same size
+        batch_size = get_config("NN_CLASSIFY_BATCH_SIZE")
+        batch_shape = (batch_size, img_height, img_width, 3)
+
+        # Load the model, either the TensorFlow Lite, the TensorRT optimized or the keras model
+        use_tflite = get_config("NN_USE_TFLITE")
+        use_trt = get_config("NN_USE_TENSORRT")
+        if use_tflite:
+            cached = exists(get_config("NN_TFLITE_FILE"))
+        else:
+            cached = exists(get_config("NN_TENSORRT_FOLDER")) if use_trt else xla_cached
+        try:
+            if use_tflite:
+                forward = _load_tflite_model(batch_shape)
+            elif use_trt:
+                forward = _load_trt_model(batch_shape)
+            else:
+                _model = tf.keras.models.load_model(get_config("NN_MODEL_FOLDER"))
+                _model.trainable = False
+                forward = lambda batch: _model(batch, training=False)
+        except Exception as e:
+            ready.set()
+            logger.error("Failed to load Model: %s" % (e,))
+            return
+
+        # As the batch size is fixed, XLA compiles and fuses the whole forward pass
+        # only once. TensorRT engines are already optimized and cannot be compiled by XLA.
+        # The color channels are swapped from BGR to RGB within the graph, this
+        # avoids converting each image on the CPU before it is fed to the network.
+        # The TensorFlow Lite interpreter runs outside of the graph and takes the BGR batch
+        @tf.function(input_signature=[tf.TensorSpec(batch_shape, tf.uint8)], jit_compile=not use_trt)
+        def infer_graph(batch):
+            batch = tf.reverse(tf.cast(batch, tf.float32), axis=[-1])
+            return forward(batch)
+        infer = forward if use_tflite else infer_graph
+
         # Initialize the network by using it
-        # This ensures everything is preloaded when needed
-        if True:
-
-            # Load all images from the "Images" folder and feed them to the neural network
-            # This ensures that the network is fully running when we start other processes
-            test_images = ["Images/"+f for f in listdir("Images") if isfile(join("Images", f))]
-            imgs = []
-            for item in test_images:
-                img = tf.io.read_file(item)
-                img = tf.image.decode_jpeg(img, channels=3)
-                img = tf.image.resize(img, [img_height, img_width])
-                imgs.append(img)
-
-            # Perform prediction
-            _model.predict_on_batch(tf.convert_to_tensor(imgs))
+        # Feed the images from the "Images" folder to the neural network, this ensures
+        # that the network is fully running when we start other processes.
+        # If the optimized model was cached, a single batch is sufficient
+        if cached:
+            infer(np.zeros(batch_shape, dtype=np.uint8))
+        else:
+            for batch in _load_test_batches(batch_shape):
+                infer(batch)
 
         # Mark process as ready
-        ready.value = True
+        ready.set()
 
         # Create folders to store images with positive results
         if get_config("SAVE_DETECTION_IMAGES"):
-            for lbl in ["varroa", "pollen", "wasps", "cooling"]:
+            for lbl in LABELS:
                 s_path = get_config("SAVE_DETECTION_PATH")
                 if not exists(join(s_path, lbl)):
                     makedirs(join(s_path, lbl))
 
         classify_thres = get_config("CLASSIFICATION_THRESHOLDS")
+        classify_thres = np.array([classify_thres[lbl] for lbl in LABELS])
+        batch_window = get_config("NN_CLASSIFY_BATCH_WINDOW")
+        save_images = get_config("SAVE_DETECTION_IMAGES")
+        save_types = get_config("SAVE_DETECTION_TYPES")
+        save_path = get_config("SAVE_DETECTION_PATH")
+
+        def report(pending):
+            """! Waits for the results of a batch and pushes them to the out-queue
+            """
+            results, tracks, images_orig, process_cnt, start_t = pending
+
+            # Compare the results of all images and labels with their thresholds at once
+            hits = np.hstack([np.asarray(r)[:len(tracks)] for r in results]) > classify_thres
+
+            # precess results
+            for num, t_data in enumerate(tracks):
+
+                track, frame_id = t_data
+
+                # Create dict with results
+                entry = set([])
+                for lbl_id in np.flatnonzero(hits[num]):
+                    lbl = LABELS[lbl_id]
+                    entry.add(lbl)
+
+                    # Save the corresponding image on disc
+                    if save_images and lbl in save_types:
+
+                        img = images_orig[num]
+                        cv2.imwrite(save_path + "/%s/%i-%s-%i.jpeg" % (lbl, process_cnt, \
+                                datetime.now().strftime("%Y%m%d-%H%M%S"), frame_id), img)
+
+                # Push results back, bees without any characteristic are not reported,
+                # as an empty result doesn't change the track or the statistics
+                if entry:
+                    q_out.put((track, entry))
+
+            _end_t = time.time() - start_t
+            logger.debug("Process time: %0.3fms - Batch: %i, processed %i" % (_end_t * 1000.0, process_cnt, len(tracks)))
+            return _end_t
+
+        # The images are written directly into one of two preallocated batches. While the
+        # network processes one batch, the next batch is collected in the other one and
+        # the results are fetched afterwards. Slots beyond the amount of collected images
+        # keep older images, their results are ignored
+        batches = (np.zeros(batch_shape, dtype=np.uint8), np.zeros(batch_shape, dtype=np.uint8))
+        pending = None
         while stopped.value == 0:
 
-            # While the image classification queue is not empty
-            # feed the images to the network and push the result
-            # back in the outgoing queue
-            if not q_in.empty():
-                _start_t = time.time()
-                _process_cnt += 1
-
-                images = []
-                images_orig = []
-                tracks = []
-
-                # Load the images from the in-queue and prepare them for the use in the network
-                failed = False
-                while len(images) < 5 and stopped.value == 0:
-                    try:
-                        item = q_in.get(block=False)
-                    except queue.Empty:
-                        item = None
-                        break
-
-                    if not item is None:
-                        t, img, frame_id = item
-                        # Change color from BGR to RGB
-                        images_orig.append(img)
-                        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                        if img.shape != (img_height, img_width, 3):
-                            img = tf.image.resize(img, [img_height, img_width])
-                        images.append(img)
-                        tracks.append((t, frame_id))
-
-                # Quit process if requested
-                if stopped.value != 0:
-                    return
-
-                # Feed collected images to the network
-                if len(tracks):
-                    results = _model.predict_on_batch(tf.convert_to_tensor(images))
-
-                    # precess results
-                    for num, t_data in enumerate(tracks):
-
-                        track, frame_id = t_data
-
-                        # Create dict with results
-                        entry = set([])
-                        for lbl_id, lbl in enumerate(["varroa", "pollen", "wasps", "cooling"]):
-                            if results[lbl_id][num][0] > classify_thres[lbl]:
-                                entry.add(lbl)
-
-                                # Save the corresponding image on disc
-                                if get_config("SAVE_DETECTION_IMAGES") and lbl in get_config("SAVE_DETECTION_TYPES"):
-
-                                    img = images_orig[num]
-                                    cv2.imwrite(get_config("SAVE_DETECTION_PATH") + "/%s/%i-%s-%i.jpeg" % (lbl, _process_cnt, \
-                                            datetime.now().strftime("%Y%m%d-%H%M%S"), frame_id), img)
-
-                        # Push results back
-                        q_out.put((tracks[num][0], entry))
-
-                _end_t = time.time() - _start_t
-                logger.debug("Process time: %0.3fms - Queued: %i, processed %i" % (_end_t * 1000.0, q_in.qsize(), len(images)))
-                _process_time += _end_t
-            else:
-                time.sleep(0.5)
+            # Wait for the first image of the next batch, don't wait if
+            # there are results left to report
+            try:
+                item = q_in.get(timeout=0.5) if pending is None else q_in.get(block=False)
+            except queue.Empty:
+                if pending is not None:
+                    _process_time += report(pending)
+                    pending = None
+                continue
+
+            _start_t = time.time()
+            _process_cnt += 1
+
+            batch = batches[_process_cnt % 2]
+            images_orig = []
+            tracks = []
+
+            # Keep collecting images until the batch is full or the batch window
+            # elapsed, this feeds the network with larger batches when only a few
+            # bees pass the camera
+            deadline = time.monotonic() + batch_window
+            while True:
+                t, img, frame_id = item
+                if img.shape == (img_height, img_width, 3):
+                    batch[len(tracks)] = img
+                else:
+                    cv2.resize(img, (img_width, img_height), dst=batch[len(tracks)])
+                images_orig.append(img)
+                tracks.append((t, frame_id))
+
+                remaining = deadline - time.monotonic()
+                if len(tracks) >= batch_size or remaining <= 0 or stopped.value != 0:
+                    break
+                try:
+                    item = q_in.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            # Quit process if requested
+            if stopped.value != 0:
+                return
+
+            # Feed collected images to the network, this returns before the
+            # network has finished, then report the results of the previous batch
+            results = infer(batch)
+            if pending is not None:
+                _process_time += report(pending)
+            pending = (results, tracks, images_orig, _process_cnt, _start_t)
+
         logger.info("Classifcation stopped")
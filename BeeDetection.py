@@ -1,49 +1,134 @@
 import cv2
 import logging
 import numpy as np
-import math
+from numba import njit
 from Utils import get_config
 
 logger = logging.getLogger(__name__)
 
+# Maps V - G to 255 - (G - V) computed with uint8 wrap around
+_SUB_LUT = ((np.arange(256) - 1) % 256).astype(np.uint8)
+
+# 1D kernel of the separable 9x9 gaussian blur (sigma 9)
+_BLUR_KERNEL = cv2.getGaussianKernel(9, 9, cv2.CV_32F)
+
+# Single channel buffers used by 'detect_bees', allocated once per frame size
+_buffers = {}
+
+
+def _get_buffers(shape):
+    """! Returns four preallocated single channel images of the given shape
+    @param  shape   The (height, width) of the buffers
+    @return A list of four uint8 arrays
+    """
+    if shape not in _buffers:
+        _buffers[shape] = [np.empty(shape, dtype=np.uint8) for i in range(4)]
+    return _buffers[shape]
+
+def _to_ellipses(rows):
+    """! Converts rows of (x, y, width, height, angle) to cv2 ellipses
+    @param  rows    Array (N, 5) of ellipse parameters
+    @return A list of ellipses ((x, y), (width, height), angle)
+    """
+    return [((x, y), (w, h), a) for x, y, w, h, a in rows.tolist()]
+
+@njit(cache=True)
+def _find_root(parent, i):
+    while parent[i] != i:
+        i = parent[i]
+    return i
+
+@njit(cache=True)
+def _merge_nearby(centers, areas, max_dist):
+    """! Groups all ellipses whose centers are closer than 'max_dist' to each other
+    @param  centers     Array (N, 2) containing the ellipse centers
+    @param  areas       Array (N,) containing the ellipse areas
+    @param  max_dist    The distance below which ellipses are grouped
+    @return Array of indices, one per group, pointing to the ellipse with the biggest area
+    """
+    n = centers.shape[0]
+    max_dist2 = max_dist * max_dist
+
+    # Union-find over all pairs that are close to each other
+    parent = np.arange(n)
+    for i in range(n):
+        for j in range(i + 1, n):
+            dx = centers[i, 0] - centers[j, 0]
+            dy = centers[i, 1] - centers[j, 1]
+            if dx * dx + dy * dy < max_dist2:
+                root_i = _find_root(parent, i)
+                root_j = _find_root(parent, j)
+                if root_i != root_j:
+                    parent[root_j] = root_i
+
+    # Select the ellipse with the biggest area for each group
+    best = np.full(n, -1)
+    for i in range(n):
+        root = _find_root(parent, i)
+        if best[root] == -1 or areas[i] > areas[best[root]]:
+            best[root] = i
+    return best[best >= 0]
 
-def detect_bees(frame, scale):
 
-    # Helper method to calculate distance between to ellipses
-    def near(p1,p2):
-        return math.sqrt(math.pow(p1[0]-p2[0], 2) + math.pow(p1[1]-p2[1], 2))
+def detect_bees(frame, scale):
 
     # Helper method to calculate the area of an ellipse
     def area(e1):
         return np.pi * e1[1][0] * e1[1][1]
 
-    # Extract BGR and HSV channels
-    b,g,r = cv2.split(frame)
-    hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-    h,s,v = cv2.split(hsv)
-
-    # Substract G and V
-    o = 255 - (g - v)
+    # Extract BGR channels
+    b,g,r,o = _get_buffers(frame.shape[0:2])
+    cv2.split(frame, [b, g, r])
 
-    # Blur Image and perform a binary thresholding
-    o = cv2.GaussianBlur(o, (9,9), 9)
-    _, o = cv2.threshold(o, get_config("BINARY_THRESHOLD_VALUE"), \
-            get_config("BINARY_THRESHOLD_MAX"), cv2.THRESH_BINARY)
+    # Substract G and V, where V is the value channel of the HSV color space,
+    # that is max(B, G, R). So V - G equals max(B, R) - G saturated at zero.
+    cv2.max(b, r, dst=o)
+    cv2.subtract(o, g, dst=o)
+    cv2.LUT(o, _SUB_LUT, dst=o)
 
-    # Invert result
-    o = 255 -o
+    # Blur Image and perform an inverted binary thresholding
+    cv2.sepFilter2D(o, -1, _BLUR_KERNEL, _BLUR_KERNEL, dst=b)
+    cv2.threshold(b, get_config("BINARY_THRESHOLD_VALUE"), \
+            get_config("BINARY_THRESHOLD_MAX"), cv2.THRESH_BINARY_INV, dst=o)
 
-    # Detect contours
-    contours, hierarchy = cv2.findContours(o, cv2.RETR_LIST, cv2.CHAIN_APPROX_TC89_KCOS)
+    # Detect contours, only the outer contours are of interest, holes within bees are skipped
+    contours, hierarchy = cv2.findContours(o, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_KCOS)
     ellipses = []
     groups = []
+
+    # Bounds to reject contours before fitting an ellipse. The contour area is
+    # roughly a quarter of the area calculated by 'area', the bounds are
+    # chosen loose enough to not reject any contour that could pass below
+    ellipse_min = get_config("DETECT_ELLIPSE_AREA_MIN_SIZE")
+    ellipse_max = get_config("DETECT_ELLIPSE_AREA_MAX_SIZE")
+    group_min = get_config("DETECT_GROUP_AREA_MIN_SIZE")
+    group_max = get_config("DETECT_GROUP_AREA_MAX_SIZE")
+    min_area = min(ellipse_min, group_min) / 16
+    max_area = max(ellipse_max, group_max) / 2
+    use_min_area_rect = get_config("DETECT_USE_MIN_AREA_RECT")
     for i in range(len(contours)):
 
         # Only countours with more than five edges can fit an ellipse
         if(len(contours[i]) >= 5):
 
-            # Fit ellipse
-            e = cv2.fitEllipse(contours[i])
+            # Skip contours that are far too small or too large, fitting an ellipse is expensive
+            contourArea = cv2.contourArea(contours[i])
+            if contourArea < min_area or contourArea > max_area:
+                continue
+            _, _, w, h = cv2.boundingRect(contours[i])
+            if w < 4 or h < 4:
+                continue
+
+            # Fit ellipse, or approximate it by the rotated bounding rectangle which is
+            # faster to calculate. The rectangle is converted to the convention of
+            # fitEllipse, where the width is the smaller axis and the angle is in [0, 180)
+            if use_min_area_rect:
+                (cx, cy), (w, h), angle = cv2.minAreaRect(contours[i])
+                if w > h:
+                    w, h, angle = h, w, angle + 90
+                e = ((cx, cy), (w, h), angle % 180)
+            else:
+                e = cv2.fitEllipse(contours[i])
 
             # Skip too small detections
             if e[1][0] < 8 or e[1][1] < 8:
@@ -51,57 +136,19 @@ def detect_bees(frame, scale):
 
             # Only use ellipses with minium size
             ellipseArea = area(e)
-            if ellipseArea > get_config("DETECT_ELLIPSE_AREA_MIN_SIZE") \
-                    and ellipseArea < get_config("DETECT_ELLIPSE_AREA_MAX_SIZE"):
+            if ellipseArea > ellipse_min and ellipseArea < ellipse_max:
+                ellipses.append((e[0][0], e[0][1], e[1][0], e[1][1], e[2]))
+            elif ellipseArea > group_min and ellipseArea < group_max:
+                groups.append((e[0][0], e[0][1], e[1][0], e[1][1], e[2]))
 
-                # Scale ellipse to desired size
-                e = ((e[0][0] * scale, e[0][1] * scale), (e[1][0] * scale, e[1][1] * scale), e[2])
-                ellipses.append(e)
-            elif ellipseArea > get_config("DETECT_GROUP_AREA_MIN_SIZE") and \
-                    ellipseArea < get_config("DETECT_GROUP_AREA_MAX_SIZE"):
-
-                # Scale ellipse to desired size
-                e = ((e[0][0] * scale, e[0][1] * scale), (e[1][0] * scale, e[1][1] * scale), e[2])
-                groups.append(e)
+    # Scale all ellipses to desired size at once
+    ellipses = np.array(ellipses, dtype=np.float64).reshape(-1, 5)
+    groups = np.array(groups, dtype=np.float64).reshape(-1, 5)
+    ellipses[:, 0:4] *= scale
+    groups[:, 0:4] *= scale
 
     # Merge nearby detection into one
-    done = []
-    skip = []
-    solved = []
-    for a in ellipses:
-
-        # Find ellipses that are close to each other and store them as a group
-        group = []
-        for b in ellipses:
-
-            # Skip self and already processed ellipes
-            if (a,b) in done or (b,a) in done or a == b:
-                continue
-            done.append((a,b))
-
-            # Calculate distance between both ellipses
-            dist = near(a[0],b[0])
-            if dist < 50:
-
-                # Put them into the group
-                if a not in group:
-                    group.append(a)
-                if b not in group:
-                    group.append(b)
-
-                # Remember which ellipses were processed
-                if not a in skip:
-                    skip.append(a)
-                if not b in skip:
-                    skip.append(b)
-
-        # Isolate the ellipse with the biggest area
-        if len(group):
-            solved.append(max(group, key=area))
-
-    # Merge isolated ellipses with remaining ones
-    rest = list(filter(lambda x: x not in skip, ellipses))
-    merged = rest + solved
-
-    return merged, groups
+    areas = np.pi * ellipses[:, 2] * ellipses[:, 3]
+    merged = ellipses[_merge_nearby(ellipses[:, 0:2], areas, 50)]
 
+    return _to_ellipses(merged), _to_ellipses(groups)
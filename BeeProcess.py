@@ -7,10 +7,13 @@
 # @section authors Author(s)
 # - Created by Fabian Hickert on december 2022
 #
+import os
 import time
 import signal
 import logging
 import multiprocessing
+import cv2
+from Utils import get_config, set_realtime_priority
 logger = logging.getLogger(__name__)
 
 class BeeProcess(object):
@@ -18,7 +21,7 @@ class BeeProcess(object):
         """! Initializes the defaults
         """
         self._stopped = multiprocessing.Value('i', 0)
-        self._done = multiprocessing.Value('i', 0)
+        self._done = multiprocessing.Event()
         self._process = None
         self._process_params = {}
         self._parentclass = self.__class__
@@ -28,23 +31,31 @@ class BeeProcess(object):
         self._process_params[name] = queue
 
     def isDone(self):
-        return self._done.value
+        return self._done.is_set()
     
     def isStarted(self):
         return self._started
 
+    def getSentinel(self):
+        """! Returns a handle of the started process that becomes ready once the process
+             ended, to wait for it with 'multiprocessing.connection.wait'
+        """
+        return self._process.sentinel
+
+    def requestStop(self):
+        """! Signals the process to stop without waiting for it. Several processes
+             can be signaled this way first, so they shut down at the same time
+        """
+        self._stopped.value = 1
+
     def stop(self):
         """! Forces the process to stop
         """
 
         # Wait for process to stop
 
-        self._stopped.value = 1
-        for i in range(100):
-            if self._done.value == 1:
-                break
-            time.sleep(0.01)
-        if self._done.value == 0:
+        self.requestStop()
+        if self._started and not self._done.wait(timeout=1.0):
             logger.warn("Terminating process after waiting 1s for gracefull shutdown!")
             self._process.terminate()
 
@@ -56,8 +67,16 @@ class BeeProcess(object):
                 except:
                     pass
 
+        # Reap the process, it is killed if it still doesn't exit
+        if self._started:
+            self._process.join(timeout=1.0)
+            if self._process.is_alive():
+                logger.warn("Killing process that did not exit after 1s!")
+                self._process.kill()
+                self._process.join()
+
     def join(self):
-        if self._stopped.value == 0 and self._done.value == 0 and self._started:
+        if self._stopped.value == 0 and not self._done.is_set() and self._started:
             self._process.join()
 
     @staticmethod
@@ -73,13 +92,28 @@ class BeeProcess(object):
         parent = args["parent"]
         stopped = args["stopped"]
         done = args["done"]
+
+        # Restrict the process to its configured CPU cores
+        cores = get_config("PROCESS_CPU_AFFINITY").get(parent.__name__)
+        if cores and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+            logger.debug("%s runs on cores %s", parent.__name__, cores)
+
+        # Raise the scheduling priority of time critical processes
+        set_realtime_priority(parent.__name__)
+
+        # Limit the threads OpenCV may use within the process
+        threads = get_config("WORKER_THREADS")
+        if threads:
+            cv2.setNumThreads(threads)
+
         try:
             parent.run(**args)
         except KeyboardInterrupt as ki:
             logger.debug(">> Received KeyboardInterrupt")
-
-        stopped.value = 1
-        done.value = 1
+        finally:
+            stopped.value = 1
+            done.set()
             
     def start(self):
         """! Starts the image extraction process
@@ -12,8 +12,8 @@
 # @section authors Author(s)
 # - Created by Fabian Hickert on december 2020
 #
-from filterpy.common import kinematic_kf
-from collections import deque
+from scipy.optimize import linear_sum_assignment
+from numba import njit
 import numpy as np
 import math
 import cv2
@@ -21,10 +21,164 @@ import logging
 import random
 
 from Statistics import getStatistics
-from Utils import loadWomanNames, variance_of_laplacian, pointInEllipse, get_config
+from Utils import loadWomanNames, variance_of_laplacian, pointsInEllipses, get_config
 
 logger = logging.getLogger(__name__)
 
+# Assignment cost for pairs of tracks and detections that must not be matched
+_NO_MATCH_COST = 1e9
+
+# Tags that can be reported by the classification
+_TAGS = ("wasps", "varroa", "cooling", "pollen")
+
+# Bit of each tag, used to store the tags of all tracks in a single array
+_TAG_BITS = {tag: 1 << i for i, tag in enumerate(_TAGS)}
+
+# Kalman filter model, a constant acceleration model in x and y,
+# the state is ordered as [x, vx, ax, y, vy, ay]
+_KF_DT = 1
+_KF_F = np.array([[1, _KF_DT, _KF_DT**2/2, 0, 0, 0],
+                  [0, 1,      _KF_DT,      0, 0, 0],
+                  [0, 0,      1,           0, 0, 0],
+                  [0, 0, 0, 1, _KF_DT, _KF_DT**2/2],
+                  [0, 0, 0, 0, 1,      _KF_DT     ],
+                  [0, 0, 0, 0, 0,      1          ]], dtype=np.float32)
+_KF_H = np.array([[1, 0, 0, 0, 0, 0],
+                  [0, 0, 0, 1, 0, 0]], dtype=np.float32)
+_KF_R = np.eye(2, dtype=np.float32) * 2
+_KF_Q = np.array(
+             [[_KF_DT**4/4,     _KF_DT**3/2,   _KF_DT**4/2,    0,0,0 ],
+              [_KF_DT**3/2,     _KF_DT**2,     _KF_DT**4,      0,0,0 ],
+              [_KF_DT**3/1,     _KF_DT**1,     _KF_DT**1/2,    0,0,0 ],
+              [0,0,0, _KF_DT**4/4,     _KF_DT**3/2,   _KF_DT**4/2 ],
+              [0,0,0, _KF_DT**3/2,     _KF_DT**2,     _KF_DT**4   ],
+              [0,0,0, _KF_DT**3/1,     _KF_DT**1,     _KF_DT**1/2 ]
+         ], dtype=np.float32)
+
+
+@njit(cache=True)
+def _kf_predict(x, P, F, Q):
+    """! Kalman prediction step
+    @return The predicted state and covariance
+    """
+    return F @ x, F @ P @ F.T + Q
+
+
+# Transition and accumulated process noise for predicting multiple steps at once
+_KF_STEPS = {1: (_KF_F, _KF_Q)}
+
+
+def _kf_model(k):
+    """! Returns the transition F^k and the process noise accumulated over k steps
+    @param k    The number of steps to predict
+    @return A tuple (F, Q) for the given number of steps
+    """
+    if k not in _KF_STEPS:
+        F, Q = _kf_model(k - 1)
+        _KF_STEPS[k] = (_KF_F @ F, _KF_F @ Q @ _KF_F.T + _KF_Q)
+    return _KF_STEPS[k]
+
+
+def _kf_predict_all(states, covs, k=1):
+    """! Kalman prediction step for many filters sharing the same model
+    @param states   The stacked states of shape (T, 6, 1)
+    @param covs     The stacked covariances of shape (T, 6, 6)
+    @param k        The number of steps to predict at once
+    @return The predicted states and covariances
+    """
+    F, Q = _kf_model(k)
+    return F @ states, F @ covs @ F.T + Q
+
+
+@njit(cache=True)
+def _assignment_cost(preds, lasts, detections, threshold):
+    """! Calculates the distance of each track to each detection, the smaller one of the
+         distances to the tracks prediction and to its last position is used
+    @return The distance matrix and the assignment cost matrix, where pairs
+            that are too far away have a prohibitive cost
+    """
+    dist = np.empty((preds.shape[0], detections.shape[0]))
+    cost = np.empty((preds.shape[0], detections.shape[0]))
+    for t in range(preds.shape[0]):
+        for d in range(detections.shape[0]):
+            dx = preds[t, 0] - detections[d, 0]
+            dy = preds[t, 1] - detections[d, 1]
+            dp = math.sqrt(dx*dx + dy*dy)
+            dx = lasts[t, 0] - detections[d, 0]
+            dy = lasts[t, 1] - detections[d, 1]
+            dist[t, d] = min(dp, math.sqrt(dx*dx + dy*dy))
+            cost[t, d] = dist[t, d] if dist[t, d] < threshold else _NO_MATCH_COST
+    return dist, cost
+
+
+@njit(cache=True)
+def _kf_update(x, P, z, H, R):
+    """! Kalman correction step, the covariance is updated using the Joseph form
+    @return The corrected state and covariance
+    """
+    PHT = P @ H.T
+    S = H @ PHT + R
+    K = PHT @ np.linalg.inv(S)
+    x = x + K @ (z - H @ x)
+    I_KH = np.eye(P.shape[0], dtype=P.dtype) - K @ H
+    P = I_KH @ P @ I_KH.T + K @ R @ K.T
+    return x, P
+
+
+@njit(cache=True)
+def _kf_update_all(states, covs, zs, H, R):
+    """! Kalman correction step for many filters sharing the same model
+    @param states   The stacked states of shape (T, 6, 1)
+    @param covs     The stacked covariances of shape (T, 6, 6)
+    @param zs       The stacked measurements of shape (T, 2, 1)
+    @return The corrected states and covariances
+    """
+    for i in range(states.shape[0]):
+        x, P = _kf_update(states[i], covs[i], zs[i], H, R)
+        states[i] = x
+        covs[i] = P
+    return states, covs
+
+
+class BeeTrace(object):
+    """! The 'BeeTrace' stores the last detections of a track in a preallocated ring buffer.
+         It can be used like the 'deque' it replaces: append, len and indexing.
+    """
+    def __init__(self, maxlen, width=5):
+        """! Initializes the ring buffer
+        @param maxlen   The maximum amount of detections to keep
+        @param width    The amount of values of each detection
+        """
+        self._buf = np.zeros((maxlen, width))
+        self._head = 0
+        self._len = 0
+
+    def append(self, position):
+        """! Appends a detection, the oldest one is dropped once the buffer is full
+        @param position     The detection (x, y, w, h, angle)
+        """
+        self._buf[self._head, 0:len(position)] = position
+        self._head = (self._head + 1) % len(self._buf)
+        self._len = min(self._len + 1, len(self._buf))
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, idx):
+        """! Returns the detection at the given position, negative values count from the end
+        @return A view into the ring buffer, only valid until the entry gets overwritten
+        """
+        if idx < -self._len or idx >= self._len:
+            raise IndexError("trace index out of range")
+        return self._buf[(self._head - self._len + idx % self._len) % len(self._buf)]
+
+    def points(self):
+        """! Returns the [x,y] coordinates of all detections ordered from oldest to newest
+        @return An int32 array of shape (N, 2)
+        """
+        idx = (np.arange(self._len) + self._head - self._len) % len(self._buf)
+        return self._buf[idx, 0:2].astype(np.int32)
+
 
 class BeeTrack():
 
@@ -42,21 +196,12 @@ class BeeTrack():
         ## The tracks ID
         self.trackId = trackId
 
-        # Initialize the klaman filter
-        self.dt = 1
-        self.KF = kinematic_kf(dim=2, order=2, dt=self.dt, dim_z=1, order_by_dim=True)
-        self.KF.R *= 2
-        self.KF.Q = np.array(
-                         [[self.dt**4/4,     self.dt**3/2,   self.dt**4/2,    0,0,0 ],
-                          [self.dt**3/2,     self.dt**2,     self.dt**4,      0,0,0 ],
-                          [self.dt**3/1,     self.dt**1,     self.dt**1/2,    0,0,0 ],
-                          [0,0,0, self.dt**4/4,     self.dt**3/2,   self.dt**4/2 ],
-                          [0,0,0, self.dt**3/2,     self.dt**2,     self.dt**4   ],
-                          [0,0,0, self.dt**3/1,     self.dt**1,     self.dt**1/2 ]
-                     ])
+        # Initialize the klaman filter state and covariance
+        self.x = np.zeros((6, 1), dtype=np.float32)
+        self.P = np.eye(6, dtype=np.float32)
 
         # Keep track of the
-        self.trace = deque(maxlen=get_config("MAX_BEE_TRACE_LENGTH"))
+        self.trace = BeeTrace(get_config("MAX_BEE_TRACE_LENGTH"))
 
         # Amount of missed detetions
         self.skipped_frames = 0
@@ -103,15 +248,14 @@ class BeeTrack():
             _dh.addClassificationResultByTag(self.trackId, tag)
 
         # Add the tag
-        self.tags |= set((tag,))
-        self.reported_tags |= set((tag,))
+        self.tags.add(tag)
+        self.reported_tags.add(tag)
 
     def imageClassificationComplete(self, result):
         """! Merge classification results into this track
         @param results  A tuple, any of ("wasps", "varroa", "cooling", "pollen")
         """
-        values = ["wasps", "varroa", "cooling", "pollen"]
-        for item in values:
+        for item in _TAGS:
             if item in result:
                 self.addTag(item)
 
@@ -119,8 +263,8 @@ class BeeTrack():
         """! Forces the position, which is reprenseted by the kalman filter, to the given position
         @param  position    List continaing [x,y] coordinates
         """
-        self.KF.x[0] = position[0]
-        self.KF.x[3] = position[1]
+        self.x[0] = position[0]
+        self.x[3] = position[1]
 
         # Add the position to the trace
         if len(self.trace) == 0:
@@ -130,16 +274,142 @@ class BeeTrack():
     def predict(self):
         """! Perform the kalman prediction
         """
-        self.KF.predict()
-        self.last_predict = self.KF.x
-        return self.KF.x
+        self.x, self.P = _kf_predict(self.x, self.P, _KF_F, _KF_Q)
+        self.last_predict = self.x
+        return self.x
 
     def correct(self, position):
         """! Perform the kalman correction
         @param  position    The actual position of the bee, to correct to
         """
         self.trace.append(position)
-        self.KF.update(position[0:2])
+        z = np.asarray(position[0:2], dtype=np.float32).reshape(2, 1)
+        self.x, self.P = _kf_update(self.x, self.P, z, _KF_H, _KF_R)
+
+
+class BeeTrackerSnapshot(object):
+    """! The 'BeeTrackerSnapshot' holds the state of the 'BeeTracker' that is needed to draw
+         the tracks. Each attribute is stored as a single array over all tracks, which makes
+         it cheap to send the snapshot to the visualizer process, compared to the whole tracker.
+    """
+    def __init__(self, tracks, track_colors, dist_threshold):
+        """! Collects the drawing state of all tracks that have more than one waypoint
+        @param tracks           The list of 'BeeTrack' instances
+        @param track_colors     The list of colors to choose the track colors from
+        @param dist_threshold   The distance threshold of the tracker
+        """
+        tracks = [track for track in tracks if len(track.trace) > 1]
+        traces = [track.trace.points() for track in tracks]
+
+        self.ids = np.array([track.trackId for track in tracks], dtype=np.int32)
+        self.positions = np.array([track.trace[-1][0:2] for track in tracks]).astype(np.int32).reshape(-1, 2)
+        self.predictions = np.array([track.last_predict[:, 0] for track in tracks], dtype=np.float32).reshape(-1, 6)
+        self.in_group = np.array([track.in_group for track in tracks], dtype=bool)
+        self.tags = np.array([sum(_TAG_BITS[tag] for tag in track.tags) for track in tracks], dtype=np.uint8)
+
+        # The traces of all tracks are concatenated, the offsets mark where each trace starts
+        self.traces = np.concatenate(traces) if traces else np.zeros((0, 2), dtype=np.int32)
+        self.trace_offsets = np.cumsum([0] + [len(pts) for pts in traces])
+
+        self.names = [track._name for track in tracks]
+        self.colors = [track_colors[track.trackId % len(track_colors)] for track in tracks]
+        self.dist_threshold = dist_threshold
+
+    def drawTracks(self, frame):
+        """! Draw the tracks on the given frame.
+        Draw tracks, names, ids, groups, ... depending on configuration
+        @param  frame   The frame to draw on
+        @return The resulting frame
+        """
+
+        # Read the drawing configuration once per frame
+        draw_group_marker = get_config("DRAW_GROUP_MARKER")
+        draw_rectangle = get_config("DRAW_RECTANGLE_OVER_LAST_POSTION")
+        draw_trace = get_config("DRAW_TRACK_TRACE")
+        draw_prediction = get_config("DRAW_TRACK_PREDICTION")
+        draw_velocity = get_config("DRAW_VELOCITY")
+        draw_acceleration = get_config("DRAW_ACCELERATION")
+        draw_track_id = get_config("DRAW_TRACK_ID")
+
+        # Draw tracks and detections
+        for i in range(len(self.ids)):
+
+            # Select a track color
+            t_c = self.colors[i]
+
+            # The last position of the track
+            x = int(self.positions[i, 0])
+            y = int(self.positions[i, 1])
+
+            # Draw marker that shows tracks underneath groups
+            if draw_group_marker and self.in_group[i]:
+                tl = (x-30,y-30)
+                br = (x+30,y+30)
+                cv2.rectangle(frame,tl,br,(0,0,0),10)
+
+            # Draw rectangle over last position
+            if draw_rectangle:
+                tl = (x-10,y-10)
+                br = (x+10,y+10)
+                cv2.rectangle(frame,tl,br,t_c,1)
+
+            # Draw trace
+            if draw_trace:
+                pts = self.traces[self.trace_offsets[i]:self.trace_offsets[i+1]]
+                cv2.polylines(frame, [pts], False, t_c, 4)
+                cv2.polylines(frame, [pts], False, (0,0,0), 1)
+
+            # Draw prediction
+            if draw_prediction:
+                p_x = int(self.predictions[i, 0])
+                p_y = int(self.predictions[i, 3])
+                cv2.circle(frame,(p_x,p_y), self.dist_threshold, (0,0,255), 1)
+
+            # Draw velocity, acceleration
+            if draw_acceleration or draw_velocity:
+                l_p = self.predictions[i]
+
+                l_px = int(l_p[0])
+                v_px = int(l_p[1])*10 + l_px
+                a_px = int(l_p[2])*10 + l_px
+                l_py = int(l_p[3])
+                v_py = int(l_p[4])*10 + l_py
+                a_py = int(l_p[5])*10 + l_py
+
+                if draw_velocity:
+                    cv2.line(frame, (l_px, l_py), (v_px, v_py), (255,255,255), 4)
+                    cv2.line(frame, (l_px, l_py), (v_px, v_py), t_c, 2)
+
+                if draw_acceleration:
+                    cv2.line(frame, (l_px, l_py), (a_px, a_py), (255,255,255), 8)
+                    cv2.line(frame, (l_px, l_py), (a_px, a_py), t_c, 6)
+
+            if self.tags[i] & _TAG_BITS["varroa"]:
+                cv2.circle(frame, (x-10, y-50), 9, (0, 0, 255), -1)
+                cv2.circle(frame, (x-10, y-50), 10, (0, 0, 0), 2)
+            if self.tags[i] & _TAG_BITS["pollen"]:
+                cv2.circle(frame, (x-30, y-50), 9, (255, 0, 0), -1)
+                cv2.circle(frame, (x-30, y-50), 10, (0, 0, 0), 2)
+            if self.tags[i] & _TAG_BITS["cooling"]:
+                cv2.circle(frame, (x+10, y-50), 9, (0, 255, 0), -1)
+                cv2.circle(frame, (x+10, y-50), 10, (0, 0, 0), 2)
+            if self.tags[i] & _TAG_BITS["wasps"]:
+                cv2.circle(frame, (x+30, y-50), 9,(0, 0, 0), -1)
+                cv2.circle(frame, (x+30, y-50), 10, (0, 0, 0), 2)
+
+            # Add Track Id
+            if draw_track_id:
+                cv2.putText(frame, str(self.ids[i]) + " " + \
+                        self.names[i], (x,y-30),
+                        cv2.FONT_HERSHEY_DUPLEX, 1, (255,255,255))
+        # Draw count of bees
+        if get_config("DRAW_IN_OUT_STATS"):
+            _dh = getStatistics()
+            bees_in, bees_out = _dh.getBeeCountOverall()
+            cv2.putText(frame,"In: %i, Out: %i" % (bees_in, bees_out), (50,50),
+                cv2.FONT_HERSHEY_SIMPLEX, 2, (0,0,0), 5)
+
+        return frame
 
 
 class BeeTracker(object):
@@ -154,6 +424,10 @@ class BeeTracker(object):
         self.max_frame_skipped = max_frame_skipped
         self.trackId = 0
         self.tracks = []
+        self._trackById = {}
+
+        # Frames skipped without detection, the next update predicts over all of them
+        self._skipped_steps = 0
         self.names = loadWomanNames()
         self._frame_height = frame_size[1]
         self._frame_width = frame_size[0]
@@ -171,10 +445,7 @@ class BeeTracker(object):
         @param  trackId     The track id to return a track for
         @return The 'BeeTrack' object, if it exists else None
         """
-        for item in self.tracks:
-            if item.trackId == trackId:
-                return item
-        return None
+        return self._trackById.get(trackId)
 
     def drawTracks(self, frame):
         """! Draw the current tracker status on the given frame.
@@ -182,97 +453,13 @@ class BeeTracker(object):
         @param  frame   The frame to draw on
         @return The resulting frame
         """
+        return self.snapshot().drawTracks(frame)
 
-        # Draw tracks and detections
-        for j in range(len(self.tracks)):
-
-            # Only Draw tracks that have more than one waypoints
-            if len(self.tracks[j].trace) > 1:
-
-                # Select a track color
-                t_c = self.track_colors[self.tracks[j].trackId % len(self.track_colors)]
-
-                # Draw marker that shows tracks underneath groups
-                if get_config("DRAW_GROUP_MARKER") and self.tracks[j].in_group:
-                    x = int(self.tracks[j].trace[-1][0])
-                    y = int(self.tracks[j].trace[-1][1])
-                    tl = (x-30,y-30)
-                    br = (x+30,y+30)
-                    cv2.rectangle(frame,tl,br,(0,0,0),10)
-
-                # Draw rectangle over last position
-                if get_config("DRAW_RECTANGLE_OVER_LAST_POSTION"):
-                    x = int(self.tracks[j].trace[-1][0])
-                    y = int(self.tracks[j].trace[-1][1])
-                    tl = (x-10,y-10)
-                    br = (x+10,y+10)
-                    cv2.rectangle(frame,tl,br,t_c,1)
-
-                # Draw trace
-                if get_config("DRAW_TRACK_TRACE"):
-                    for k in range(len(self.tracks[j].trace)):
-                        x = int(self.tracks[j].trace[k][0])
-                        y = int(self.tracks[j].trace[k][1])
-
-                        if k > 0:
-                            x2 = int(self.tracks[j].trace[k-1][0])
-                            y2 = int(self.tracks[j].trace[k-1][1])
-                            cv2.line(frame,(x,y), (x2,y2), t_c, 4)
-                            cv2.line(frame,(x,y), (x2,y2), (0,0,0), 1)
-
-                # Draw prediction
-                if get_config("DRAW_TRACK_PREDICTION"):
-                    x = int(self.tracks[j].last_predict[0])
-                    y = int(self.tracks[j].last_predict[3])
-                    cv2.circle(frame,(x,y), self.dist_threshold, (0,0,255), 1)
-
-                # Draw velocity, acceleration
-                if get_config("DRAW_ACCELERATION") or get_config("DRAW_VELOCITY"):
-                    l_p = self.tracks[j].last_predict
-
-                    l_px = int(l_p[0])
-                    v_px = int(l_p[1])*10 + l_px
-                    a_px = int(l_p[2])*10 + l_px
-                    l_py = int(l_p[3])
-                    v_py = int(l_p[4])*10 + l_py
-                    a_py = int(l_p[5])*10 + l_py
-
-                    if DRAW_VELOCITY:
-                        cv2.line(frame, (l_px, l_py), (v_px, v_py), (255,255,255), 4)
-                        cv2.line(frame, (l_px, l_py), (v_px, v_py), t_c, 2)
-
-                    if DRAW_ACCELERATION:
-                        cv2.line(frame, (l_px, l_py), (a_px, a_py), (255,255,255), 8)
-                        cv2.line(frame, (l_px, l_py), (a_px, a_py), t_c, 6)
-
-                x = int(self.tracks[j].trace[-1][0])
-                y = int(self.tracks[j].trace[-1][1])
-                if "varroa" in self.tracks[j].tags:
-                    cv2.circle(frame, (x-10, y-50), 9, (0, 0, 255), -1)
-                    cv2.circle(frame, (x-10, y-50), 10, (0, 0, 0), 2)
-                if "pollen" in self.tracks[j].tags:
-                    cv2.circle(frame, (x-30, y-50), 9, (255, 0, 0), -1)
-                    cv2.circle(frame, (x-30, y-50), 10, (0, 0, 0), 2)
-                if "cooling" in self.tracks[j].tags:
-                    cv2.circle(frame, (x+10, y-50), 9, (0, 255, 0), -1)
-                    cv2.circle(frame, (x+10, y-50), 10, (0, 0, 0), 2)
-                if "wasps" in self.tracks[j].tags:
-                    cv2.circle(frame, (x+30, y-50), 9,(0, 0, 0), -1)
-                    cv2.circle(frame, (x+30, y-50), 10, (0, 0, 0), 2)
-
-                # Add Track Id
-                if get_config("DRAW_TRACK_ID"):
-                    cv2.putText(frame, str(self.tracks[j].trackId) + " " + \
-                            self.tracks[j]._name, (x,y-30),
-                            cv2.FONT_HERSHEY_DUPLEX, 1, (255,255,255))
-        # Draw count of bees
-        if get_config("DRAW_IN_OUT_STATS"):
-            _dh = getStatistics()
-            bees_in, bees_out = _dh.getBeeCountOverall()
-            cv2.putText(frame,"In: %i, Out: %i" % (bees_in, bees_out), (50,50),
-                cv2.FONT_HERSHEY_SIMPLEX, 2, (0,0,0), 5)
-
-        return frame
+    def snapshot(self):
+        """! Returns the current tracker status that is needed to draw the tracks
+        @return A 'BeeTrackerSnapshot' instance
+        """
+        return BeeTrackerSnapshot(self.tracks, self.track_colors, self.dist_threshold)
 
     def getLastBeePositions(self, frame_step):
         """! Returns a list of all tracks last positions
@@ -284,7 +471,7 @@ class BeeTracker(object):
             track = self.tracks[j]
             if len(track.trace) and track.skipped_frames == 0 and \
                     track.processed_frames % frame_step == 0:
-                data.append((self.tracks[j].trackId, self.tracks[j].trace[-1]))
+                data.append((self.tracks[j].trackId, self.tracks[j].trace[-1].copy()))
         return data
 
     def isOutOfPane(self, pos):
@@ -321,36 +508,31 @@ class BeeTracker(object):
             if f_y < pH and l_y >= pH:
                 _dh.addBeeOut()
 
+        del self._trackById[track.trackId]
         del self.tracks[trackId]
 
+    def skipFrame(self):
+        """! Skips a frame without detections, the tracks are advanced by an additional
+             step with the next call to 'update'
+        """
+        self._skipped_steps += 1
+
     def update(self, detections: list, groups: list):
         """! Update all the tracks with the given list of detections.
         """
         # Convert ellipses to numpy array
-        tmp  = np.zeros((len(detections), 5))
-        for i, item in enumerate(detections):
-            tmp[i] = np.concatenate((item[0], item[1], [item[2]]), axis=0)
-        detections = tmp
-
-        # Helper to mark matches
-        def matched(item):
-            t = item[1]
-            d = item[2]
-            used_tracks.append(t)
-            used_detections.append(d)
-            self.tracks[t]._last_dectect = detections[d]
-            self.tracks[t].correct(detections[d])
-            self.tracks[t].skipped_frames = 0
-            self.tracks[t].processed_frames += 1
-
-        # Calculate the distance on each track to the detections
-        dist_list = []
-        for num_t, item_t in enumerate(self.tracks):
+        detections = np.array([(e[0][0], e[0][1], e[1][0], e[1][1], e[2]) for e in detections],
+                dtype=np.float64).reshape(-1, 5)
+
+        # Tracks inside of a group also keep their last detected position
+        preds = np.zeros((len(self.tracks), 2))
+        lasts = np.full((len(self.tracks), 2), np.inf)
+
+        # Check which tracks are under a group of bees
+        in_group = pointsInEllipses([t.trace[-1][0:2] for t in self.tracks], groups).any(axis=1)
 
-            # Check whether this track is under a group of bees
-            item_t.in_group = False
-            for g in groups:
-                item_t.in_group |= pointInEllipse(item_t.trace[-1], g)
+        for num_t, item_t in enumerate(self.tracks):
+            item_t.in_group = bool(in_group[num_t])
 
             # Prepare the tracks
             # Assume that each trach has missed a detection/frame
@@ -360,132 +542,87 @@ class BeeTracker(object):
             # If the bee is inside of a group, then recude the kalman gain
             # to slow it down.
             if item_t.in_group:
-                item_t.KF.x[1] = item_t.KF.x[1] * 0.5
-                item_t.KF.x[2] = item_t.KF.x[2] * 0.5
-                item_t.KF.x[4] = item_t.KF.x[4] * 0.5
-                item_t.KF.x[5] = item_t.KF.x[5] * 0.5
+                item_t.x[[1, 2, 4, 5]] *= 0.5
                 item_t.skipped_frames -= 1
-
-            pred = item_t.predict()
-            for num_d, item_d in enumerate(detections):
-
-                # Instead of only using the track prediction, try also to
-                #  match with tracks last position
-                if item_t.in_group:
-                    lastValidPosition = item_t._last_dectect
-                    p_diff = (np.array([lastValidPosition[0],
-                            lastValidPosition[1]]).reshape(-1,2) -
-                            np.array(item_d[0:2]).reshape(-1,2))[0]
-                    p_dist = math.sqrt(p_diff[0]*p_diff[0] + p_diff[1]*p_diff[1])
-                    dist_list.append((p_dist, num_t, num_d))
-
-                # Get the tracks prediction and calculate its distance to each detection
-                p_diff = (np.array([pred[0], pred[3]]).reshape(-1,2) -
-                        np.array(item_d[0:2]).reshape(-1,2))[0]
-
-                p_dist = math.sqrt(p_diff[0]*p_diff[0] + p_diff[1]*p_diff[1])
-
-                # Store each (distance, track_id, detection_id) for further processing
-                dist_list.append((p_dist, num_t, num_d))
-
-        # Sort distance list be least distance first
-        dist_list = sorted(dist_list, key=lambda entry: entry[0])
-
-        # Try to the best match for each track
-        used_tracks = []
-        used_detections = []
-
-        for item in dist_list:
-            dist, num_t, num_d = item
-
-            # Skip those entry that refer to already assigned tracks or detections
-            if num_t in used_tracks or num_d in used_detections:
-                continue
-
-            # Get the track
-            track = self.tracks[num_t]
-
-            # Get all detections for this track
-            per_track = list(filter(lambda x: x[1] == num_t, dist_list))
-
-            # Filter out used detections
-            per_track = list(filter(lambda x: x[2] not in used_detections, per_track))
-
-            # Filter by distance, distance is twice as large for new tracks
-            distance = self.dist_threshold
-
-            # This is a new track, it cannot make predictions about where the bee will go
-            # Double the detection range
-            if track.processed_frames > track.skipped_frames:
-                distance = self.dist_threshold *2
-
-            # This track recently missed some detections, but had a solid track before.
-            # Double the detection range
-            if track.processed_frames > track.skipped_frames:
-                distance = self.dist_threshold *2
-
-            # This Track is inside of a bee-group, so it cannot be detected
-            # As we can only assume were the bee is going, double the distance
-            if track.in_group:
-                distance = self.dist_threshold *2
-
-            by_dist = list(filter(lambda x: x[0] < self.dist_threshold, per_track))
-
-            # Only one finding, that is our match
-            if len(by_dist) == 1:
-                matched(by_dist[0])
-            elif len(by_dist) > 1:
-                print("Multiple findings")
-                print(by_dist)
-
-                # Simply use first one right now
-                matched(by_dist[0])
-                #for item in by_dist:
-                #
-                #    print(item, self.tracks[item[1]]._name)
+                lasts[num_t] = item_t._last_dectect[0:2]
+
+        # Advance the kalman filters of all tracks at once, they share the same model.
+        # Frames skipped since the last update are predicted in the same step
+        steps = self._skipped_steps + 1
+        self._skipped_steps = 0
+        if len(self.tracks):
+            states, covs = _kf_predict_all(
+                    np.stack([t.x for t in self.tracks]),
+                    np.stack([t.P for t in self.tracks]), steps)
+            for num_t, item_t in enumerate(self.tracks):
+                item_t.x = item_t.last_predict = states[num_t]
+                item_t.P = covs[num_t]
+            preds = states[:, [0, 3], 0]
+
+        # Calculate the distance of each track prediction to each detection at once.
+        # Instead of only using the track prediction, tracks inside of a group
+        # also match with their last position
+        dist, cost = _assignment_cost(preds.astype(np.float64), lasts, detections, self.dist_threshold)
+
+        # Find the best overall assignment of tracks to detections,
+        # pairs that are too far away are excluded
+        rows, cols = linear_sum_assignment(cost)
+        valid = dist[rows, cols] < self.dist_threshold
+        used_tracks = rows[valid]
+        used_detections = cols[valid]
+
+        # Correct the kalman filters of all matched tracks at once
+        if len(used_tracks):
+            states, covs = _kf_update_all(
+                    np.stack([self.tracks[t].x for t in used_tracks]),
+                    np.stack([self.tracks[t].P for t in used_tracks]),
+                    detections[used_detections, 0:2].astype(np.float32).reshape(-1, 2, 1),
+                    _KF_H, _KF_R)
+            for num_m, (num_t, num_d) in enumerate(zip(used_tracks, used_detections)):
+                track = self.tracks[num_t]
+                track._last_dectect = detections[num_d]
+                track.trace.append(detections[num_d])
+                track.x = states[num_m]
+                track.P = covs[num_m]
+                track.skipped_frames = 0
+                track.processed_frames += 1
 
         # Delete tracks that didn't match any of the last detections
         IN = 0
         OUT = 0
 
-        for num_t in reversed(range(len(self.tracks))):
-            item = self.tracks[num_t]
-
-            # Remove tracks that were used just once
-            if num_t not in used_tracks and \
-                    item.skipped_frames > 0 and item.processed_frames == 0:
-                self._delTrack(num_t, count=False)
-
-            # Remove tracks that have more losses than hits
-            elif num_t not in used_tracks and \
-                    item.skipped_frames > item.processed_frames:
-                self._delTrack(num_t, count=False)
+        # Gather the per-track counters once and evaluate the removal rules for all tracks at once
+        unused = np.ones(len(self.tracks), dtype=bool)
+        unused[used_tracks] = False
+        skipped = np.array([t.skipped_frames for t in self.tracks], dtype=np.int64)
+        processed = np.array([t.processed_frames for t in self.tracks], dtype=np.int64)
+        last_y = np.array([t.trace[-1][1] for t in self.tracks], dtype=np.float64)
 
-            # Remove tracks that exceeded max frame skip
-            elif self.tracks[num_t].skipped_frames > self.max_frame_skipped:
-                self._delTrack(num_t, count=False)
+        # Remove tracks that were used just once, have more losses than hits
+        # or exceeded max frame skip
+        drop = (unused & (skipped > 0) & (processed == 0)) | \
+               (unused & (skipped > processed)) | \
+               (skipped > self.max_frame_skipped)
 
-            # Remove tracks that hit the entry or exit of the hive and have a frame skip
-            elif self.isOutOfPane(self.tracks[num_t].trace[-1]):
-                self._delTrack(num_t, count=True)
+        # Remove tracks whose last position or prediction hit the entry or exit of the hive,
+        # these are counted
+        out_of_pane = (last_y < 5) | (last_y > (self._frame_height - 5)) | \
+                      (preds[:, 1] < 5) | (preds[:, 1] > (self._frame_height - 5))
+        count = ~drop & out_of_pane
 
-            # Remove tracks that hit the entry or exit of the hive and have a frame skip
-            elif self.isOutOfPane([self.tracks[num_t].last_predict[0], \
-                    self.tracks[num_t].last_predict[3]]):
-                self._delTrack(num_t, count=True)
+        for num_t in reversed(np.flatnonzero(drop | count)):
+            self._delTrack(num_t, count=bool(count[num_t]))
 
         # Create tracks for unmatched detections
-        unmatched_detections = list(filter(lambda x: x not in used_detections,
-                range(len(detections))))
-        for item in unmatched_detections:
-
-            # Only create new BeeTrack for bees that are on the pane
-            if True:
-                track = BeeTrack(self.trackId)
-                track.setTrackName(random.choice(self.names))
-                track._last_dectect = detections[item]
-                self.tracks.append(track)
-                track.setPosition(detections[item])
-                self.trackId += 1
+        unmatched = np.ones(len(detections), dtype=bool)
+        unmatched[used_detections] = False
+        for item in np.flatnonzero(unmatched):
+            track = BeeTrack(self.trackId)
+            track.setTrackName(random.choice(self.names))
+            track._last_dectect = detections[item]
+            self.tracks.append(track)
+            self._trackById[track.trackId] = track
+            track.setPosition(detections[item])
+            self.trackId += 1
 
         return (IN, OUT)
@@ -7,21 +7,16 @@
 # @section authors Author(s)
 # - Created by Fabian Hickert on december 2020
 #
-import cv2
 import time
 import logging
 import queue
-import multiprocessing
 from Statistics import getStatistics
-from ImageProvider import ImageProvider
 from BeeDetection import detect_bees
-from BeeTracking import BeeTracker, BeeTrack
-from Utils import get_config, get_args
+from BeeTracking import BeeTracker
+from Utils import get_config, get_frame_config
 from BeeProcess import BeeProcess
-if get_config("NN_ENABLE"):
-    from BeeClassification import BeeClassification
+from SharedImageQueue import SharedImageQueue
 
-from multiprocessing import Queue
 
 logger = logging.getLogger(__name__)
 
@@ -34,7 +29,10 @@ class ImageConsumer(BeeProcess):
         """! Intitilizes the 'ImageConsumer'
         """
         super().__init__()
-        self._extractQueue = Queue()
+
+        # The extraction uses the largest frame of the frame set
+        h, w = get_frame_config()[0][0:2]
+        self._extractQueue = SharedImageQueue(maxsize=1, shape=(h, w, 3))
         self._classifierResultQueue = None
         self._imageQueue = None
         self._visualQueue = None
@@ -43,6 +41,12 @@ class ImageConsumer(BeeProcess):
         self.set_process_param("i_q", self._imageQueue)
         self.set_process_param("v_q", self._visualQueue)
 
+    def stop(self):
+        """! Stops the process and releases the shared memory of the extraction queue
+        """
+        super().stop()
+        self._extractQueue.unlink()
+
     def getPositionQueue(self):
         """! Returns the queue object where detected bee positions will be put
         @return A queue object
@@ -78,7 +82,10 @@ class ImageConsumer(BeeProcess):
         _process_cnt = 0
         _lastProcessFPS = 0
         _start_t = time.time()
-        writer = None
+
+        # Average time needed to process a frame, used to skip detections when running behind
+        _frame_load = 0
+        _skip_next = False
 
         # Create a Bee Tracker
         tracker = BeeTracker(50, 20)
@@ -86,40 +93,87 @@ class ImageConsumer(BeeProcess):
         # Create statistics object
         statistics = getStatistics()
 
-        if type(i_q) == type(None):
+        if i_q is None:
             raise("No image queue provided!")
 
+        # Read the configuration once, it doesn't change while running
+        nn_enable = get_config("NN_ENABLE")
+        tracking_enabled = get_config("ENABLE_TRACKING")
+        extraction_enabled = get_config("ENABLE_IMAGE_EXTRACTION")
+        extract_frame_step = get_config("EXTRACT_FAME_STEP")
+        visualization_enabled = get_config("VISUALIZATION_ENABLED")
+        visualization_frame_skip = get_config("VISUALIZATION_FRAME_SKIP")
+        skip_when_behind = get_config("SKIP_DETECTION_WHEN_BEHIND")
+        drop_old = get_config("FRAME_SET_DROP_POLICY") == "drop_old"
+        limit_time = 1 / get_config("LIMIT_FPS_TO")
+        if get_config("NN_EXTRACT_RESOLUTION") not in ("EXT_RES_150x300", "EXT_RES_75x150"):
+            raise BaseException("Unknown setting for NN_EXTRACT_RESOLUTION, expected EXT_RES_150x300 or EXT_RES_75x150")
+        # Extraction cuts from the largest frame of the set, the scale maps the detections
+        # made on img_540 onto it. img_1080 is only part of the set for the full resolution
+        extract_scale = 2 if get_config("NN_EXTRACT_RESOLUTION") == "EXT_RES_150x300" else 1
+        _deadline = time.monotonic() + limit_time
+
         while stopped.value == 0:
 
             _process_cnt += 1
 
             # When the neural network is enabled, then read results from the classifcation queue
             # and forward them the the corresponding track and statistics
-            if get_config("NN_ENABLE"):
+            if nn_enable:
 
-                # Populate classification results
-                while not c_q.empty():
+                # Populate classification results, limited per frame so that a flooded
+                # result queue can't delay the frame processing
+                for _ in range(32):
+                    try:
+                        trackId, result = c_q.get_nowait()
+                    except queue.Empty:
+                        break
 
                     # Transfer results to the track
-                    trackId, result = c_q.get()
                     track = tracker.getTrackById(trackId)
-                    if type(track) != type(None):
+                    if track is not None:
                         track.imageClassificationComplete(result)
                     else:
                         statistics.addClassificationResult(trackId, result)
 
+            # Wait for the next frame set, at most for one frame of the FPS limit.
+            # The frames are processed directly in the shared memory of the queue
+            try:
+                slot, fs = i_q.get_views(timeout=limit_time)
+            except queue.Empty:
+                continue
+
+            # Skip to the newest queued frame set, so that the latency stays bounded
+            # when the processing is slower than the input. The tracker predicts over
+            # the dropped frames
+            if drop_old:
+                while i_q.qsize() > 0:
+                    try:
+                        next_slot, next_fs = i_q.get_views(block=False)
+                    except queue.Empty:
+                        break
+                    i_q.release(slot)
+                    slot, fs = next_slot, next_fs
+                    tracker.skipFrame()
+                    statistics.frameProcessed()
+
+            # Skip the detection when the previous frames exceeded the time budget,
+            # the tracker then predicts over the skipped frame with the next update
+            if _skip_next:
+                _skip_next = False
+                tracker.skipFrame()
+                statistics.frameProcessed()
+                i_q.release(slot)
+                continue
+            _frame_t = time.time()
+
             # Process every incoming image
-            if not i_q.empty() and stopped.value == 0:
+            if stopped.value == 0:
 
                 if _process_cnt % 100 == 0:
                     logger.debug("Process time(get): %0.3fms" % ((time.time() - _start_t) * 1000.0))
 
-                # Get frame set
-                fs = i_q.get()
-                if get_config("NN_EXTRACT_RESOLUTION") == "EXT_RES_150x300":
-                    img_1080, img_540, img_180 = fs
-                elif get_config("NN_EXTRACT_RESOLUTION") == "EXT_RES_75x150":
-                    img_540, img_180 = fs
+                img_540, img_180 = fs[-2:]
                 
                 if _process_cnt % 100 == 0:
                     logger.debug("Process time(track): %0.3fms" % ((time.time() - _start_t) * 1000.0))
@@ -128,29 +182,28 @@ class ImageConsumer(BeeProcess):
                 detected_bees, detected_bee_groups = detect_bees(img_180, 3)
                 
                 # Update tracker with detected bees
-                if get_config("ENABLE_TRACKING"):
+                if tracking_enabled:
                     tracker.update(detected_bees, detected_bee_groups)
 
                 # Extract detected bee images from the video, to use it our neural network
-                # Scale is 2 because detection was made on img_540 but cutting is on img_1080
-                if get_config("ENABLE_IMAGE_EXTRACTION"):
-                    data = tracker.getLastBeePositions(get_config("EXTRACT_FAME_STEP"))
-                    if len(data) and type(e_q) != type(None):
-                        if get_config("NN_EXTRACT_RESOLUTION") == "EXT_RES_150x300":
-                            e_q.put((data, img_1080, 2, _process_cnt))
-                        elif get_config("NN_EXTRACT_RESOLUTION") == "EXT_RES_75x150":
-                            e_q.put((data, img_540, 1, _process_cnt))
-                        else:
-                            raise("Unknown setting for EXT_RES_75x150, expected EXT_RES_150x300 or EXT_RES_75x150")
+                if extraction_enabled:
+                    data = tracker.getLastBeePositions(extract_frame_step)
+                    if len(data) and e_q is not None:
+                        # Only the latest frame is kept, older ones are dropped if the extractor is behind
+                        try:
+                            e_q.put_latest((data, fs[0], extract_scale, _process_cnt))
+                        except queue.Full:
+                            logger.debug("Extraction queue full, skipping frame %i" % (_process_cnt,))
 
                 # Draw the results if enabled
-                if get_config("VISUALIZATION_ENABLED"):
-                    if _process_cnt % get_config("VISUALIZATION_FRAME_SKIP") == 0:
+                if visualization_enabled:
+                    if _process_cnt % visualization_frame_skip == 0:
                         try:
-                            data = (img_540, detected_bees, detected_bee_groups, tracker, _lastProcessFPS) 
-                            v_q.put(data, block=False)
+                            data = (img_540, detected_bees, detected_bee_groups, tracker.snapshot(), _lastProcessFPS)
+                            if v_q.put_latest(data):
+                                logger.debug("frame skip !!")
                         except queue.Full:
-                            print("frame skip !!")
+                            logger.debug("frame skip !!")
                 
 
                 # Print log entry about process time each 100 frames
@@ -161,17 +214,24 @@ class ImageConsumer(BeeProcess):
                     _process_time = time.time()
 
                 # Update statistics
-                _dh = getStatistics()
-                _dh.frameProcessed()
-
-            else:
-                time.sleep(0.01)
-
-            # Limit FPS by delaying manually
-            _end_t = time.time() - _start_t
-            limit_time = 1 / get_config("LIMIT_FPS_TO")
-            if _end_t < limit_time:
-                time.sleep(limit_time - _end_t)
+                statistics.frameProcessed()
+
+            # Hand the frame set back to the image provider
+            i_q.release(slot)
+
+            # Track the average frame processing time
+            _frame_load = 0.9 * _frame_load + 0.1 * (time.time() - _frame_t)
+            _skip_next = skip_when_behind and _frame_load > limit_time
+
+            # Limit FPS by waiting for the deadline of the frame. The deadline advances
+            # by a fixed step, so that inaccurate sleeps don't accumulate. When running
+            # far behind, the deadline is reset instead of catching up with a burst
+            now = time.monotonic()
+            if now < _deadline:
+                time.sleep(_deadline - now)
+            _deadline += limit_time
+            if now > _deadline + limit_time:
+                _deadline = now + limit_time
             _start_t = time.time()
 
         logger.info("Image Consumer stopped")
@@ -8,19 +8,48 @@
 # @section authors Author(s)
 # - Created by Fabian Hickert on december 2020
 #
-from Utils import cutEllipseFromImage, get_config
+from Utils import cutEllipseFromImage, variance_of_laplacian, get_config
 import time
 import logging
 import cv2
 import queue
-import multiprocessing
-import datetime
-from os.path import join, exists
+import threading
+from os.path import exists
 from os import makedirs
 from BeeProcess import BeeProcess
 
 logger = logging.getLogger(__name__)
 
+def _image_writer(write_q, e_path):
+    """! Writes the queued images to disk, runs in a separate thread until None is queued
+    @param write_q  The queue providing tuples of (image number, timestamp, image)
+    @param e_path   The folder to write the images to
+    """
+    # The timestamp in the file names only has a resolution of one second,
+    # it is formatted once for all images of the same second
+    ts_sec = None
+    ts_str = ""
+    while True:
+        item = write_q.get()
+        if item is None:
+            break
+        num, timestamp, img = item
+
+        # Encode in memory and write the file in one go
+        ok, enc = cv2.imencode(".jpeg", img)
+        if not ok:
+            logger.warning("Failed to encode extracted image %i" % (num,))
+            continue
+        if int(timestamp) != ts_sec:
+            ts_sec = int(timestamp)
+            ts_str = time.strftime("%Y%m%d-%H%M%S", time.localtime(ts_sec))
+        path = e_path + "/%i-%s.jpeg" % (num, ts_str)
+        try:
+            with open(path, "wb") as f:
+                f.write(enc)
+        except OSError as e:
+            logger.warning("Failed to write extracted image %i: %s" % (num, e))
+
 class ImageExtractor(BeeProcess):
     """! The 'ImageExtractor' class provides a process that extracts
           bee-images from a givem video frame. It uses a queue for
@@ -43,11 +72,12 @@ class ImageExtractor(BeeProcess):
         super().__init__()
         self._resultQueue = None
         self._inQueue = None
+        self.set_process_param("out_q", self._resultQueue)
 
     def start(self):
         """! Starts the image extraction process
         """
-        if type(self._inQueue) == type(None):
+        if self._inQueue is None:
             raise("Please provide a classifier queue!")
 
         # Start the process
@@ -77,52 +107,89 @@ class ImageExtractor(BeeProcess):
 
         # Prepare save path
         e_path = get_config("SAVE_EXTRACTED_IMAGES_PATH")
-        if get_config("SAVE_EXTRACTED_IMAGES") and not exists(e_path):
+        save_images = get_config("SAVE_EXTRACTED_IMAGES")
+        if save_images and not exists(e_path):
             makedirs(e_path)
 
-        while stopped.value == 0:
-            if not in_q.empty():
-
-                _start_t = time.time()
-                _process_cnt += 1
-
-                # Read one entry from the process queue
-                data, image, scale, frame_id = in_q.get()
+        # Images are written to disk by a separate thread, to not block the extraction
+        write_q = None
+        if save_images:
+            write_q = queue.Queue(maxsize=64)
+            writer = threading.Thread(target=_image_writer, args=(write_q, e_path), daemon=True)
+            writer.start()
 
-                # Extract the bees from the image
-                for item in data:
-                    trackId, lastPosition = item
+        # Read the configuration once, it doesn't change while running
+        nn_enable = get_config("NN_ENABLE")
+        min_sharpness = get_config("EXTRACT_MIN_SHARPNESS")
+        sharpness_gate = get_config("EXTRACT_SHARPNESS_GATE") * min_sharpness
 
-                    # Extract the bee image and sharpness value of the image
-                    img, sharpness = cutEllipseFromImage(lastPosition, image, 0, scale)
+        # The frames are copied out of the queue into this buffer, instead of
+        # allocating a new one for every frame
+        frame = None
 
-                    # Check result, in some cases the result may be None
-                    #  e.g. when the bee is close to the image border
-                    if type(img) != type(None):
-
-                        # Filter by minimum sharpness
-                        if sharpness > get_config("EXTRACT_MIN_SHARPNESS"):
-
-                            # Forward the image to the classification process (if its running)
-                            if get_config("NN_ENABLE"):
-                                try:
-                                    out_q.put((trackId, img, frame_id), block=False)
-                                except queue.Full:
-                                    pass
-                                    
-                            # Save the image in case its requested
-                            if get_config("SAVE_EXTRACTED_IMAGES"):
-                                cv2.imwrite(e_path + "/%i-%s.jpeg" % (_process_cnt, datetime.datetime.now().strftime("%Y%m%d-%H%M%S")), img)
-
-                _process_time += time.time() - _start_t
-
-                # Print log entry about process time each 100 frames
-                if _process_cnt % 100 == 0:
-                    logger.debug("Process time: %0.3fms" % (_process_time * 10.0))
-                    _process_time = 0
+        while stopped.value == 0:
 
-            else:
-                time.sleep(0.01)
+            # Wait for the next entry of the process queue
+            try:
+                data, image, scale, frame_id = in_q.get(timeout=0.1, out=frame)
+                frame = image
+            except queue.Empty:
+                continue
+
+            _start_t = time.time()
+            _process_cnt += 1
+
+            # Extract the bees from the image
+            for item in data:
+                trackId, lastPosition = item
+
+                # Skip clearly blurry bees by testing a small patch around its center,
+                # which is much cheaper than cutting the bee from the image
+                if sharpness_gate > 0:
+                    x = int(lastPosition[0] * scale)
+                    y = int(lastPosition[1] * scale)
+                    patch = image[max(y-16, 0):y+16, max(x-16, 0):x+16]
+                    if patch.size and variance_of_laplacian(patch) < sharpness_gate:
+                        continue
+
+                # Extract the bee image and sharpness value of the image
+                img, sharpness = cutEllipseFromImage(lastPosition, image, 0, scale)
+
+                # Check result, in some cases the result may be None
+                #  e.g. when the bee is close to the image border
+                if img is not None:
+
+                    # Filter by minimum sharpness
+                    if sharpness > min_sharpness:
+
+                        # Forward the image to the classification process (if its running)
+                        if nn_enable:
+                            try:
+                                out_q.put((trackId, img, frame_id), block=False)
+                            except queue.Full:
+                                pass
+                                
+                        # Save the image in case its requested
+                        if save_images:
+                            try:
+                                write_q.put_nowait((_process_cnt, time.time(), img))
+                            except queue.Full:
+                                logger.debug("Image writer is behind, dropping extracted image")
+
+            _process_time += time.time() - _start_t
+
+            # Print log entry about process time each 100 frames
+            if _process_cnt % 100 == 0:
+                logger.debug("Process time: %0.3fms" % (_process_time * 10.0))
+                _process_time = 0
+
+        # Write the remaining images, without waiting forever for a stuck writer
+        if write_q is not None and writer.is_alive():
+            try:
+                write_q.put(None, timeout=1.0)
+                writer.join(timeout=1.0)
+            except queue.Full:
+                logger.warning("Image writer doesn't respond, remaining images are not written")
 
         # The process stopped
         logger.info("Image extractor stopped")
@@ -11,15 +11,52 @@
 #
 from Utils import get_config, get_frame_config
 from pathlib import Path
-from queue import Queue
+import queue
+import threading
 import cv2
+import numpy as np
 import time
 import logging
 import multiprocessing
 from BeeProcess import BeeProcess
+from SharedImageQueue import SharedFrameSetQueue
 
 logger = logging.getLogger(__name__)
 
+def _frame_reader(videoStream, frame_q, free_q, stopped, drop_stale):
+    """! Reads frames from the video stream, runs in a separate thread so that decoding
+         the next frame overlaps with resizing the current one. It stops after the first
+         frame that couldn't be read or when the process gets stopped
+    @param videoStream  The opened 'cv2.VideoCapture'
+    @param frame_q      The queue receiving tuples of (success, frame)
+    @param free_q       The queue providing the buffers to read the frames into
+    @param stopped      Shared value that is set when the process stops
+    @param drop_stale   Whether to drop frames instead of waiting for the processing,
+                        the queue then only holds the latest frame
+    """
+    while stopped.value == 0:
+        try:
+            buf = free_q.get_nowait() if drop_stale else free_q.get(timeout=0.1)
+        except queue.Empty:
+
+            # All buffers are in use, drop the frame without decoding it. This keeps
+            # stale frames from piling up in the camera buffer
+            if drop_stale and not videoStream.grab():
+                frame_q.put((False, None))
+                break
+            continue
+        ret, buf = videoStream.read(buf)
+
+        # Replace a frame that wasn't picked up yet by the newer one
+        if drop_stale:
+            try:
+                free_q.put(frame_q.get_nowait()[1])
+            except queue.Empty:
+                pass
+        frame_q.put((ret, buf))
+        if not ret:
+            break
+
 class ImageProvider(BeeProcess):
 
     """! The 'ImageProvider' class provides access to the camera or video
@@ -35,6 +72,10 @@ class ImageProvider(BeeProcess):
         self.frame_config = None
         self._videoStream = None
 
+        # reports when the video input got opened
+        self._ready = multiprocessing.Event()
+        self.set_process_param("ready", self._ready)
+
         # Validate the frame_config
         max_w = max_h = 0
         frame_config = get_frame_config()
@@ -55,19 +96,26 @@ class ImageProvider(BeeProcess):
             if max_h < item[1]:
                 max_h = item[1]
 
+        if get_config("FRAME_SET_DROP_POLICY") not in ("block", "drop_old", "drop_new"):
+            raise BaseException("Unknown setting for FRAME_SET_DROP_POLICY, expected block, drop_old or drop_new")
+
         # Ensure that at least one source is defined
         if video_source is None and video_file is None:
             raise BaseException("Either a video file or a video source id is required")
 
+        # The frame sets are passed through shared memory, each image has a fixed shape
+        shapes = [(item[0], item[1]) if item[2] == cv2.IMREAD_GRAYSCALE else (item[0], item[1], 3)
+                  for item in frame_config]
+
         # Prepare for reading from video file
         self.frame_config = frame_config
         if video_file is not None:
-            self._queue = multiprocessing.Queue(maxsize=get_config("FRAME_SET_BUFFER_LENGTH_VIDEO"))
             vFile = Path(video_file)
             if not vFile.is_file():
                 raise BaseException("The given file '%s' doesn't seem to be valid!" % (video_file,))
+            self._queue = SharedFrameSetQueue(get_config("FRAME_SET_BUFFER_LENGTH_VIDEO"), shapes)
         else:
-            self._queue = multiprocessing.Queue(maxsize=get_config("FRAME_SET_BUFFER_LENGTH_CAMERA"))
+            self._queue = SharedFrameSetQueue(get_config("FRAME_SET_BUFFER_LENGTH_CAMERA"), shapes)
 
         self.set_process_param("video_file", video_file)
         self.set_process_param("video_source", video_source)
@@ -75,6 +123,26 @@ class ImageProvider(BeeProcess):
         self.set_process_param("q_out", self._queue)
         self.start()
 
+    def stop(self):
+        """! Stops the process and releases the shared memory of the outgoing queue
+        """
+        super().stop()
+        self._queue.unlink()
+
+    def waitReady(self, timeout=None):
+        """! Blocks until the video input got opened or the process ended, e.g. because
+             opening the input raised an error or the process died
+        @param timeout  The maximum time to wait in seconds
+        @return True if the video input is ready to provide frames
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._ready.wait(0.1):
+            if self.isDone() or not self._process.is_alive():
+                return False
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+        return not self.isDone()
+
     def getQueue(self):
         """! Returns the queue-object where the extracted frames will be put.
         @return Returns the queue object
@@ -82,11 +150,11 @@ class ImageProvider(BeeProcess):
         return self._queue
 
     @staticmethod
-    def run(q_out, config, video_source, video_file, parent, stopped, done):
+    def run(q_out, config, video_source, video_file, ready, parent, stopped, done):
 
         # Open video stream
         if video_source == None:
-            logger.info("Starting from video file input: %s" % (video_file,))
+            logger.info("Starting from video file input: %s", video_file)
             # use HW acceleration for video file
             if get_config("USE_GSTREAM"):
                 _videoStream = cv2.VideoCapture('filesrc location={}\
@@ -108,57 +176,106 @@ class ImageProvider(BeeProcess):
             if h != None:
                 _videoStream.set(cv2.CAP_PROP_FRAME_HEIGHT, int(h))
 
+        # Report the opened input, a failed one marks the process as done first
+        if not _videoStream.isOpened():
+            logger.error("Failed to open the video input!")
+            done.set()
+            ready.set()
+            return
+        ready.set()
+
+        # Frames are read by a separate thread. It reads into a small set of buffers, which
+        # are handed back once the frame is processed, so it is at most two frames ahead.
+        # Frames of a camera are dropped when the processing is behind, this keeps the
+        # latency low, while all frames of a video file are processed
+        frame_q = queue.Queue()
+        free_q = queue.Queue()
+        for i in range(2):
+            free_q.put(None)
+        reader = threading.Thread(target=_frame_reader,
+                args=(_videoStream, frame_q, free_q, stopped, video_source is not None), daemon=True)
+        reader.start()
+
+        # The color images that are resized before being converted into gray-scale
+        # are kept in buffers that are reused for every frame
+        _gray_src = [np.empty((item[0], item[1], 3), dtype=np.uint8) if item[2] == cv2.IMREAD_GRAYSCALE else None
+                     for item in config]
+
         _process_time = 0
         _process_cnt = 0
         _skipped_cnt = 0
+        full_pause = get_config("FRAME_SET_FULL_PAUSE_TIME")
+        drop_new = get_config("FRAME_SET_DROP_POLICY") == "drop_new"
         while stopped.value == 0:
 
-            # Check if the queue is full
-            if q_out.full():
-
-                # If the queue is full, then report it
+            # Wait for a free slot in the outgoing queue, report if it stays full
+            try:
+                slot, fs = q_out.acquire(block=not drop_new, timeout=full_pause)
+            except queue.Full:
                 if _skipped_cnt % 100 == 0:
-                    logger.debug("Buffer reached %i" % (q_out.qsize(),))
-                time.sleep(get_config("FRAME_SET_FULL_PAUSE_TIME"))
+                    logger.debug("Buffer reached %i", q_out.qsize())
                 _skipped_cnt += 1
-            else:
 
-                # There is still space in the queue, get a frame and process it
-                _start_t = time.time()
-                (_ret, _frame) = _videoStream.read()
-
-                if _ret:
-
-                    # Get the original shape
-                    h, w, c = _frame.shape
-
-                    # Convert the frame according to the given configuration.
-                    # The image will be resized if necessary and converted into gray-scale
-                    #  if needed.
-                    fs = tuple()
-                    for item in config:
-                        width, height = _frame.shape[0:2]
-                        if width != item[0] or height != item[1]:
-                            _frame = cv2.resize(_frame, (item[1], item[0]))
-                        if item[2] == cv2.IMREAD_GRAYSCALE:
-                            tmp = cv2.cvtColor(_frame, cv2.COLOR_BGR2GRAY)
-                            fs += (tmp,)
-                        else:
-                            fs += (_frame,)
-
-                    # put the result in the outgoing queue
-                    q_out.put(fs)
-
-                    # Calculate the time needed to process the frame and print it
-                    _process_time += time.time() - _start_t
-                    _process_cnt += 1
-                    if _process_cnt % 100 == 0:
-                        logger.debug('FPS: %i (%i, %i)\t\t buffer size: %i' % (100/_process_time, w, h ,q_out.qsize()))
-                        _process_time = 0
-                else:
-                    logger.error("No frame received!")
-                    logger.error("> Try disabling USE_GSTREAM in the config.yaml!")
-                    stopped.value = 1
+                # Discard the next frame instead of waiting for it to be processed
+                if drop_new:
+                    try:
+                        (_ret, _capture) = frame_q.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if not _ret:
+                        logger.error("No frame received!")
+                        stopped.value = 1
+                        continue
+                    free_q.put(_capture)
+                continue
+
+            # There is space in the queue, get a frame and process it
+            _start_t = time.time()
+            _ret = None
+            while _ret is None and stopped.value == 0:
+                try:
+                    (_ret, _capture) = frame_q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+            if _ret:
+
+                # Get the original shape
+                _frame = _capture
+                h, w, c = _frame.shape
+
+                # Convert the frame according to the given configuration.
+                # The image will be resized if necessary and converted into gray-scale
+                #  if needed. The results are written directly into the shared
+                #  memory of the outgoing queue, each level is resized from the previous one
+                for item, dst, gray_src in zip(config, fs, _gray_src):
+                    height, width = _frame.shape[0:2]
+                    if item[2] == cv2.IMREAD_GRAYSCALE:
+                        if height != item[0] or width != item[1]:
+                            _frame = cv2.resize(_frame, (item[1], item[0]), dst=gray_src)
+                        cv2.cvtColor(_frame, cv2.COLOR_BGR2GRAY, dst=dst)
+                    elif height != item[0] or width != item[1]:
+                        _frame = cv2.resize(_frame, (item[1], item[0]), dst=dst)
+                    else:
+                        dst[...] = _frame
+                        _frame = dst
+
+                # put the result in the outgoing queue and hand the buffer back to the reader
+                q_out.commit(slot)
+                free_q.put(_capture)
+
+                # Calculate the time needed to process the frame and print it
+                _process_time += time.time() - _start_t
+                _process_cnt += 1
+                if _process_cnt % 100 == 0:
+                    logger.debug('FPS: %i (%i, %i)\t\t buffer size: %i', 100/_process_time, w, h, q_out.qsize())
+                    _process_time = 0
+            elif _ret is not None:
+                logger.error("No frame received!")
+                logger.error("> Try disabling USE_GSTREAM in the config.yaml!")
+                stopped.value = 1
+
+        reader.join(timeout=1.0)
 
         # End of process reached
         logger.info("Image provider stopped")
@@ -7,16 +7,19 @@
 # @section authors Author(s)
 # - Created by Fabian Hickert on december 2020
 #
-from threading import Thread
+from threading import Thread, Event
 from Statistics import getStatistics
-import time
 import logging
 from serial import Serial
 import struct
-from Utils import get_config
+from Utils import get_config, set_realtime_priority
 
 logger = logging.getLogger(__name__)
 
+# Binary layout of the transmitted monitoring results, six little endian int16 values:
+# varroa, pollen, cooling, wasps, bees in, bees out
+_PACK = struct.Struct("<6h")
+
 class LoRaWANThread(Thread):
     """! The LoRaWAN object utilizes the RB2483A transeiver from Microship
          to transfer the monitoring results to the server.
@@ -26,6 +29,7 @@ class LoRaWANThread(Thread):
         """! Initializes the class
         """
         self.stopped = False
+        self._stopEvent = Event()
         self._done = False
         self._ser = None
         Thread.__init__(self)
@@ -35,10 +39,10 @@ class LoRaWANThread(Thread):
         @param cmd  The command to be excuted
         @return     Returns the resulting response
         """
-        logger.debug("Sending command   : %s" % (cmd))
+        logger.debug("Sending command   : %s", cmd)
         self._ser.write((cmd + '\r\n').encode("UTF-8"))
         tmp = self._ser.readline().decode("UTF-8").strip()
-        logger.debug("Received          : %s" % (str(tmp)))
+        logger.debug("Received          : %s", tmp)
         return tmp
 
     def _read(self: Thread) -> str:
@@ -46,7 +50,7 @@ class LoRaWANThread(Thread):
         @return     Returns the resulting response
         """
         tmp = self._ser.readline().decode("UTF-8").strip()
-        logger.debug("Received (_read)  : %s" % (str(tmp)))
+        logger.debug("Received (_read)  : %s", tmp)
         return tmp
 
     def initialize(self: Thread):
@@ -104,6 +108,9 @@ class LoRaWANThread(Thread):
         Sends the monitoring results every five minutes
         """
 
+        # The transceiver expects prompt responses on the serial line
+        set_realtime_priority(self.__class__.__name__)
+
         # Ensure the transcevier is initialized
         try:
             self.initialize()
@@ -130,13 +137,10 @@ class LoRaWANThread(Thread):
             _dh.resetStatistics()
 
             # Prepare data
-            data = tuple([_varroaCount, _pollenCount, _coolingCount, _wespenCount, _beesIn, _beesOut])
-            data_bin = struct.pack("hhhhhh", *data)
+            data_bin = _PACK.pack(_varroaCount, _pollenCount, _coolingCount, _wespenCount, _beesIn, _beesOut)
 
             # Conver monitoring results in transferrable string
-            data_bin_str = ""
-            for item in data_bin:
-                data_bin_str += "%02X" % (item,)
+            data_bin_str = data_bin.hex().upper()
             logger.debug("Binary data: " + str(data_bin))
             logger.debug("String data: " + data_bin_str)
 
@@ -145,22 +149,21 @@ class LoRaWANThread(Thread):
             if ret == "ok":
                 ret = self._read()
                 if ret == "mac_tx_ok":
-                    logger.info("Sending successful with: %s" % (ret,))
+                    logger.info("Sending successful with: %s", ret)
                 else:
-                    logger.error("Sending failed with: %s" % (ret,))
+                    logger.error("Sending failed with: %s", ret)
 
             elif ret in ["not_joined", "silent", "frame_counter_err_rejoin_needed", "mac_paused"]:
                 fail_cnt += 1
-                logger.error("Sending failed with: %s" % (ret,))
+                logger.error("Sending failed with: %s", ret)
                 self.initialize()
             else:
                 fail_cnt += 1
-                logger.error("Sending failed with: %s" % (ret,))
+                logger.error("Sending failed with: %s", ret)
 
             # Wait for five minutes, before sending the next results
-            _start_t = time.time()
-            while not self.stopped and (_start_t + (60 * 1) > time.time()):
-                time.sleep(0.01)
+            if self._stopEvent.wait(timeout=60 * 1):
+                break
 
         # Close the serial connection
         if self._ser != None:
@@ -180,5 +183,6 @@ class LoRaWANThread(Thread):
         """! Stopps the LoRaWAN Thread and joins it
         """
         self.stopped = True
+        self._stopEvent.set()
         self.join()
 
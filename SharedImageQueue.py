@@ -0,0 +1,268 @@
+"""! @brief This module contains the 'SharedImageQueue' and 'SharedFrameSetQueue' """
+##
+# @file SharedImageQueue.py
+#
+# @brief Queue that transports images between processes using shared memory
+#
+# @section authors Author(s)
+# - Created by Fabian Hickert on december 2020
+#
+import queue
+import multiprocessing
+import numpy as np
+from multiprocessing.shared_memory import SharedMemory
+
+
+class SharedImageQueue(object):
+    """! The 'SharedImageQueue' behaves like a 'multiprocessing.Queue' for tuples
+         that carry an image. The image is copied into a fixed slot of a shared
+         memory block, only the slot number and the remaining tuple entries are
+         passed through a regular queue. This avoids pickling the image and
+         copying it through a pipe.
+    """
+
+    def __init__(self, maxsize, shape, dtype=np.uint8, image_index=1):
+        """! Initializes the shared memory and the slot queues
+        @param maxsize      The amount of images that can be queued at once
+        @param shape        The maximum shape of a single image
+        @param dtype        The data type of the images
+        @param image_index  The position of the image within the queued tuples
+        """
+        self._maxsize = maxsize
+        self._shape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+        self._image_index = image_index
+
+        size = maxsize * int(np.prod(self._shape)) * self._dtype.itemsize
+        self._shm = SharedMemory(create=True, size=size)
+        self._slots = self._view()
+
+        # Slots that can be written to and slots that hold a queued image
+        self._free = multiprocessing.Queue(maxsize)
+        self._used = multiprocessing.Queue(maxsize)
+        for slot in range(maxsize):
+            self._free.put(slot)
+
+    def _view(self):
+        return np.ndarray((self._maxsize,) + self._shape, dtype=self._dtype, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_slots"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._slots = self._view()
+
+    def put(self, item, block=True, timeout=None):
+        """! Puts the given tuple into the queue
+        @param item     The tuple to queue, the image is expected at 'image_index'
+        @param block    Whether to wait for a free slot
+        @param timeout  The maximum time to wait for a free slot
+        @raise queue.Full if there is no free slot
+        """
+        img = item[self._image_index]
+        h, w = img.shape[0:2]
+        if h > self._shape[0] or w > self._shape[1]:
+            raise ValueError("Image of shape %s exceeds the slot shape %s" % (img.shape, self._shape))
+
+        try:
+            slot = self._free.get(block, timeout)
+        except queue.Empty:
+            raise queue.Full
+        self._slots[slot, :h, :w] = img
+
+        meta = item[:self._image_index] + item[self._image_index+1:]
+        self._used.put((slot, h, w, meta))
+
+    def put_latest(self, item, timeout=0.1):
+        """! Puts the given tuple into the queue, dropping the oldest queued tuple
+             if there is no free slot. This keeps the latency of the queue bounded
+        @param item     The tuple to queue, the image is expected at 'image_index'
+        @param timeout  The maximum time to wait for the slot of the dropped tuple
+        @raise queue.Full if there is still no free slot
+        @return True if a queued tuple was dropped
+        """
+        try:
+            self.put(item, block=False)
+            return False
+        except queue.Full:
+            pass
+
+        # Drop the oldest entry and release its slot, the consumer may have taken it meanwhile
+        dropped = False
+        try:
+            slot, h, w, meta = self._used.get(timeout=0.01)
+            self._free.put(slot)
+            dropped = True
+        except queue.Empty:
+            pass
+        self.put(item, timeout=timeout)
+        return dropped
+
+    def get(self, block=True, timeout=None, out=None):
+        """! Removes and returns a tuple from the queue
+        @param block    Whether to wait for an item
+        @param timeout  The maximum time to wait for an item
+        @param out      Optional array to copy the image into, used when its shape matches
+        @raise queue.Empty if there is no item
+        @return The queued tuple, containing a copy of the image
+        """
+        slot, h, w, meta = self._used.get(block, timeout)
+        img = self._slots[slot, :h, :w]
+        if out is not None and out.shape == img.shape:
+            np.copyto(out, img)
+            img = out
+        else:
+            img = img.copy()
+        self._free.put(slot)
+        return meta[:self._image_index] + (img,) + meta[self._image_index:]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return self._used.qsize()
+
+    def empty(self):
+        return self._used.empty()
+
+    def full(self):
+        return self._free.empty()
+
+    def unlink(self):
+        """! Releases the shared memory, must only be called by its creator
+        """
+        self._slots = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+class SharedFrameSetQueue(object):
+    """! The 'SharedFrameSetQueue' transports frame sets, tuples of images with a fixed
+         shape each, through shared memory. Each image of the set gets its own shared
+         memory block. The slots are used as a ring buffer, whose state is kept in two
+         semaphores and two shared indices, so passing a frame set doesn't involve a
+         pipe or a feeder thread. It supports a single producer and a single consumer.
+    """
+
+    def __init__(self, maxsize, shapes, dtype=np.uint8):
+        """! Initializes the shared memory and the slot queues
+        @param maxsize  The amount of frame sets that can be queued at once
+        @param shapes   The shape of each image of a frame set
+        @param dtype    The data type of the images
+        """
+        self._maxsize = maxsize
+        self._shapes = [tuple(shape) for shape in shapes]
+        self._dtype = np.dtype(dtype)
+
+        self._shms = [SharedMemory(create=True, size=maxsize * int(np.prod(shape)) * self._dtype.itemsize)
+                      for shape in self._shapes]
+        self._slots = self._views()
+
+        # The amount of slots that can be written to and of slots that hold a queued frame set
+        self._free = multiprocessing.Semaphore(maxsize)
+        self._used = multiprocessing.Semaphore(0)
+
+        # The next slot to write to and the next slot to read from
+        self._head = multiprocessing.RawValue('i', 0)
+        self._tail = multiprocessing.RawValue('i', 0)
+
+    def _views(self):
+        return [np.ndarray((self._maxsize,) + shape, dtype=self._dtype, buffer=shm.buf)
+                for shape, shm in zip(self._shapes, self._shms)]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_slots"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._slots = self._views()
+
+    def put(self, fs, block=True, timeout=None):
+        """! Puts the given frame set into the queue
+        @param fs       The tuple of images, matching the configured shapes
+        @param block    Whether to wait for a free slot
+        @param timeout  The maximum time to wait for a free slot
+        @raise queue.Full if there is no free slot
+        """
+        slot, views = self.acquire(block, timeout)
+        for view, img in zip(views, fs):
+            view[...] = img
+        self.commit(slot)
+
+    def acquire(self, block=True, timeout=None):
+        """! Reserves a free slot, the frame set can then be written directly into the
+             shared memory and gets queued by calling 'commit'
+             Slots have to be committed in the order they were acquired
+        @param block    Whether to wait for a free slot
+        @param timeout  The maximum time to wait for a free slot
+        @raise queue.Full if there is no free slot
+        @return A tuple (slot, frame set), the frame set contains the writable images
+        """
+        if not self._free.acquire(block, timeout):
+            raise queue.Full
+        slot = self._head.value
+        self._head.value = (slot + 1) % self._maxsize
+        return slot, tuple(view[slot] for view in self._slots)
+
+    def commit(self, slot):
+        """! Queues the frame set written to a slot received by 'acquire'
+        @param slot     The slot to queue
+        """
+        self._used.release()
+
+    def get(self, block=True, timeout=None):
+        """! Removes and returns a frame set from the queue
+        @param block    Whether to wait for an item
+        @param timeout  The maximum time to wait for an item
+        @raise queue.Empty if there is no item
+        @return The queued frame set, containing copies of the images
+        """
+        slot, views = self.get_views(block, timeout)
+        fs = tuple(view.copy() for view in views)
+        self.release(slot)
+        return fs
+
+    def get_views(self, block=True, timeout=None):
+        """! Removes a frame set from the queue without copying it. The returned images
+             are views into the shared memory and stay valid until 'release' is called
+        @param block    Whether to wait for an item
+        @param timeout  The maximum time to wait for an item
+        @raise queue.Empty if there is no item
+        @return A tuple (slot, frame set), the slot has to be passed to 'release'
+        """
+        if not self._used.acquire(block, timeout):
+            raise queue.Empty
+        slot = self._tail.value
+        self._tail.value = (slot + 1) % self._maxsize
+        return slot, tuple(view[slot] for view in self._slots)
+
+    def release(self, slot):
+        """! Returns the slot of a frame set received by 'get_views' to the queue
+        @param slot     The slot to release
+        """
+        self._free.release()
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        return self._used.get_value()
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return self._free.get_value() == 0
+
+    def unlink(self):
+        """! Releases the shared memory, must only be called by its creator
+        """
+        self._slots = None
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
@@ -136,15 +136,12 @@ class Statistics(object):
         self._processedFames = 0
 
 
-__dh = None
+# The instance is created on import, each process works on its own copy
+__dh = Statistics()
 def getStatistics():
     """! Returns the statistics object
     #TODO: use pattern to realize singleton
     @return The statistics instance
     """
-    global __dh
-    if __dh == None:
-        __dh = Statistics()
-
     return __dh
 
@@ -8,6 +8,7 @@
 # - Created by Fabian Hickert, 2021
 #
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras import layers
 from tensorflow.keras.models import Model
@@ -21,23 +22,27 @@ from tensorflow.keras.layers import Flatten
 from tensorflow.keras.layers import Input
 from tensorflow.keras.optimizers import Adam
 
+# The images are stored as height x width x channels, which is also the fastest layout
+# for the float16 convolutions on Tensor Cores
+DATA_FORMAT = "channels_last"
 CHAN_DIM = -1
+
 def build_varroa_branch(input_shape):
     """! Creates the branch that detects varroa mite infestations
+    @param input_shape  The rescaled input images
     """
-    tmp_layer= layers.experimental.preprocessing.Rescaling(1./255)(input_shape)
-    tmp_layer= Conv2D(64, (4, 4), padding="valid")(tmp_layer)
+    tmp_layer= Conv2D(64, (4, 4), padding="valid", use_bias=False, data_format=DATA_FORMAT)(input_shape)
+    tmp_layer= BatchNormalization(axis=CHAN_DIM, fused=True)(tmp_layer)
     tmp_layer= Activation("relu")(tmp_layer)
-    tmp_layer= BatchNormalization(axis=CHAN_DIM)(tmp_layer)
-    tmp_layer= MaxPooling2D(pool_size=(2, 2))(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
 
-    tmp_layer= Conv2D(32, (3, 3), padding="valid")(tmp_layer)
+    tmp_layer= Conv2D(32, (3, 3), padding="valid", data_format=DATA_FORMAT)(tmp_layer)
     tmp_layer= Activation("relu")(tmp_layer)
-    tmp_layer= MaxPooling2D(pool_size=(2, 2))(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
 
-    tmp_layer= Conv2D(16, (3, 3), padding="valid")(tmp_layer)
+    tmp_layer= Conv2D(16, (3, 3), padding="valid", data_format=DATA_FORMAT)(tmp_layer)
     tmp_layer= Activation("relu")(tmp_layer)
-    tmp_layer= MaxPooling2D(pool_size=(2, 2))(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
 
     #tmp_layer= Conv2D(32, (2, 2), padding="valid")(tmp_layer)
     #tmp_layer= Activation("relu")(tmp_layer)
@@ -50,90 +55,162 @@ def build_varroa_branch(input_shape):
     tmp_layer= Flatten()(tmp_layer)
     tmp_layer= BatchNormalization(axis=CHAN_DIM)(tmp_layer)
     tmp_layer= Dense(1)(tmp_layer)
-    tmp_layer= Activation("sigmoid", name="varroa_output")(tmp_layer)
+    tmp_layer= Activation("sigmoid", dtype="float32", name="varroa_output")(tmp_layer)
 
     return tmp_layer
 
 def build_pollen_branch(input_shape):
     """! Creates the branch that detects pollen packets
+    @param input_shape  The rescaled input images
     """
-    tmp_layer= layers.experimental.preprocessing.Rescaling(1./255)(input_shape)
-    tmp_layer= Conv2D(32, (4, 4), padding="valid")(tmp_layer)
+    tmp_layer= Conv2D(32, (4, 4), padding="valid", use_bias=False, data_format=DATA_FORMAT)(input_shape)
+    tmp_layer= BatchNormalization(axis=CHAN_DIM, fused=True)(tmp_layer)
     tmp_layer= Activation("relu")(tmp_layer)
-    tmp_layer= BatchNormalization(axis=CHAN_DIM)(tmp_layer)
-    tmp_layer= MaxPooling2D(pool_size=(2, 2))(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
 
-    tmp_layer= Conv2D(16, (3, 3), padding="valid")(tmp_layer)
+    tmp_layer= Conv2D(16, (3, 3), padding="valid", data_format=DATA_FORMAT)(tmp_layer)
     tmp_layer= Activation("relu")(tmp_layer)
-    tmp_layer= MaxPooling2D(pool_size=(2, 2))(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
 
     tmp_layer= Flatten()(tmp_layer)
     tmp_layer= BatchNormalization(axis=CHAN_DIM)(tmp_layer)
     tmp_layer= Dense(1)(tmp_layer)
-    tmp_layer= Activation("sigmoid", name="pollen_output")(tmp_layer)
+    tmp_layer= Activation("sigmoid", dtype="float32", name="pollen_output")(tmp_layer)
 
     return tmp_layer
 
 def build_wasps_branch(input_shape):
     """! Creates the branch that detects wasps
+    @param input_shape  The rescaled input images
     """
-    tmp_layer= layers.experimental.preprocessing.Rescaling(1./255)(input_shape)
-    tmp_layer= Conv2D(16, (4, 4), padding="valid")(tmp_layer)
+    tmp_layer= Conv2D(16, (4, 4), padding="valid", use_bias=False, data_format=DATA_FORMAT)(input_shape)
+    tmp_layer= BatchNormalization(axis=CHAN_DIM, fused=True)(tmp_layer)
     tmp_layer= Activation("relu")(tmp_layer)
-    tmp_layer= BatchNormalization(axis=CHAN_DIM)(tmp_layer)
-    tmp_layer= MaxPooling2D(pool_size=(2, 2))(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
 
-    tmp_layer= Conv2D(8, (3, 3), padding="valid")(tmp_layer)
+    tmp_layer= Conv2D(16, (3, 3), padding="valid", data_format=DATA_FORMAT)(tmp_layer)
     tmp_layer= Activation("relu")(tmp_layer)
-    tmp_layer= MaxPooling2D(pool_size=(2, 2))(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
 
     tmp_layer= Flatten()(tmp_layer)
-    tmp_layer= BatchNormalization()(tmp_layer)
+    tmp_layer= BatchNormalization(axis=CHAN_DIM)(tmp_layer)
     tmp_layer= Dense(1)(tmp_layer)
-    tmp_layer= Activation("sigmoid", name="wasps_output")(tmp_layer)
+    tmp_layer= Activation("sigmoid", dtype="float32", name="wasps_output")(tmp_layer)
 
     return tmp_layer
 
 def build_cooling_branch(input_shape):
     """! Created the branch that detects bees that are cooling the hive
+    @param input_shape  The rescaled input images
     """
-    tmp_layer= layers.experimental.preprocessing.Rescaling(1./255)(input_shape)
-    tmp_layer= Conv2D(64, (2, 2), padding="valid")(tmp_layer)
+    tmp_layer= Conv2D(64, (2, 2), padding="valid", use_bias=False, data_format=DATA_FORMAT)(input_shape)
+    tmp_layer= BatchNormalization(axis=CHAN_DIM, fused=True)(tmp_layer)
+    tmp_layer= Activation("relu")(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
+
+    tmp_layer= Conv2D(32, (3, 3), padding="valid", data_format=DATA_FORMAT)(tmp_layer)
     tmp_layer= Activation("relu")(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
+
+    tmp_layer= Conv2D(16, (2, 2), padding="valid", data_format=DATA_FORMAT)(tmp_layer)
+    tmp_layer= Activation("relu")(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
+
+    tmp_layer= Flatten()(tmp_layer)
     tmp_layer= BatchNormalization(axis=CHAN_DIM)(tmp_layer)
-    tmp_layer= MaxPooling2D(pool_size=(2, 2))(tmp_layer)
+    tmp_layer= Dense(1)(tmp_layer)
+    tmp_layer= Activation("sigmoid", dtype="float32", name="cooling_output")(tmp_layer)
 
-    tmp_layer= Conv2D(32, (3, 3), padding="valid")(tmp_layer)
+    return tmp_layer
+
+def build_shared_trunk(input_shape):
+    """! Creates the feature extractor that is shared by the heads of the shared trunk model
+    @param input_shape  The rescaled input images
+    """
+    tmp_layer= Conv2D(64, (4, 4), padding="valid", use_bias=False, data_format=DATA_FORMAT)(input_shape)
+    tmp_layer= BatchNormalization(axis=CHAN_DIM, fused=True)(tmp_layer)
     tmp_layer= Activation("relu")(tmp_layer)
-    tmp_layer= MaxPooling2D(pool_size=(2, 2))(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
 
-    tmp_layer= Conv2D(16, (2, 2), padding="valid")(tmp_layer)
+    tmp_layer= Conv2D(32, (3, 3), padding="valid", data_format=DATA_FORMAT)(tmp_layer)
     tmp_layer= Activation("relu")(tmp_layer)
-    tmp_layer= MaxPooling2D(pool_size=(2, 2))(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
+
+    return tmp_layer
+
+def build_head(features, name):
+    """! Creates a small head on top of the shared features, that detects a single characteristic
+    @param features     The output of the shared trunk
+    @param name         The name of the characteristic, the output is named '<name>_output'
+    """
+    tmp_layer= Conv2D(16, (3, 3), padding="valid", data_format=DATA_FORMAT)(features)
+    tmp_layer= Activation("relu")(tmp_layer)
+    tmp_layer= MaxPooling2D(pool_size=(2, 2), data_format=DATA_FORMAT)(tmp_layer)
 
     tmp_layer= Flatten()(tmp_layer)
     tmp_layer= BatchNormalization(axis=CHAN_DIM)(tmp_layer)
     tmp_layer= Dense(1)(tmp_layer)
-    tmp_layer= Activation("sigmoid", name="cooling_output")(tmp_layer)
+    tmp_layer= Activation("sigmoid", dtype="float32", name=name + "_output")(tmp_layer)
 
     return tmp_layer
 
-def get_bee_model(img_height, img_width):
-    """! Creates BeeModel and returns it
+class AccumulatingModel(Model):
+    """! Functional model that sums up the gradients of several batches before
+         applying them. This trains with a larger effective batch size than fits
+         into the memory of small devices like the JetsonNano
     """
-    input_shape = (img_height, img_width, 3)
-    inputs = Input(shape=input_shape, name="input")
 
-    pollen_m = build_pollen_branch(inputs)
-    varroa_m = build_varroa_branch(inputs)
-    wasps_m = build_wasps_branch(inputs)
-    cooling_m = build_cooling_branch(inputs)
+    def __init__(self, *args, accumulation_steps=1, **kwargs):
+        """! Initializes the model and the accumulated gradients
+        @param accumulation_steps   The amount of batches to accumulate
+        """
+        super().__init__(*args, **kwargs)
+        self.accumulation_steps = accumulation_steps
+        self._accumulated = [tf.Variable(tf.zeros_like(var), trainable=False)
+                             for var in self.trainable_variables]
+        self._accumulated_cnt = tf.Variable(0, trainable=False, dtype=tf.int64)
 
-    model = Model(
-        inputs=inputs,
-        outputs=[varroa_m, pollen_m, wasps_m, cooling_m],
-        name="beenet")
+    def train_step(self, data):
+        """! Calculates the gradients of a batch and applies the accumulated
+             gradients once enough batches were seen
+        @param data     The batch, a tuple of images and labels
+        @return The current metrics
+        """
+        if self.accumulation_steps <= 1:
+            return super().train_step(data)
+
+        x, y = data
+        scaled = isinstance(self.optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+        with tf.GradientTape() as tape:
+            y_pred = self(x, training=True)
+            loss = self.compiled_loss(y, y_pred, regularization_losses=self.losses)
+            if scaled:
+                loss = self.optimizer.get_scaled_loss(loss)
+        gradients = tape.gradient(loss, self.trainable_variables)
+        if scaled:
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
+
+        for acc, grad in zip(self._accumulated, gradients):
+            acc.assign_add(grad / self.accumulation_steps)
+        self._accumulated_cnt.assign_add(1)
+
+        if self._accumulated_cnt % self.accumulation_steps == 0:
+            self.optimizer.apply_gradients(zip(self._accumulated, self.trainable_variables))
+            for acc in self._accumulated:
+                acc.assign(tf.zeros_like(acc))
+
+        self.compiled_metrics.update_state(y, y_pred)
+        return {metric.name: metric.result() for metric in self.metrics}
 
+def compile_bee_model(model, learning_rate=0.0005, mixed_precision=False, decay_steps=None, jit_compile=False):
+    """! Compiles the BeeModel with its losses and optimizer
+    @param model            The BeeModel
+    @param learning_rate    The initial learning rate
+    @param mixed_precision  Whether the model is trained with the mixed_float16 policy
+    @param decay_steps      The amount of training steps to decay the learning rate over,
+                            following a cosine. The learning rate stays constant if not set
+    @param jit_compile      Compile the whole training step, including the optimizer, with XLA
+    """
     losses = {
             "varroa_output": tf.losses.BinaryCrossentropy(),
             "pollen_output": tf.losses.BinaryCrossentropy(),
@@ -147,13 +224,168 @@ def get_bee_model(img_height, img_width):
             "cooling_output": 1.0
             }
 
-    opt = Adam(lr=0.0005, decay=0.0005 / 100)
+    if decay_steps:
+        learning_rate = tf.keras.optimizers.schedules.CosineDecay(learning_rate, decay_steps)
+
+    # AdamW is part of Keras since TensorFlow 2.11
+    if hasattr(tf.keras.optimizers, "AdamW"):
+        opt = tf.keras.optimizers.AdamW(learning_rate=learning_rate, weight_decay=5e-6)
+    else:
+        opt = Adam(learning_rate=learning_rate)
+    if mixed_precision:
+        opt = tf.keras.mixed_precision.LossScaleOptimizer(opt)
 
+    options = {"jit_compile": True} if jit_compile else {}
     model.compile(
          optimizer=opt,
          loss=losses,
          metrics=["accuracy"],
          loss_weights=loss_weights,
+         **options
          )
 
+def get_bee_model(img_height, img_width, mixed_precision=False, accumulation_steps=1, shared_trunk=False,
+                  decay_steps=None, jit_compile=False):
+    """! Creates BeeModel and returns it
+    @param img_height           The height of the input images
+    @param img_width            The width of the input images
+    @param mixed_precision      Train in float16 with float32 weights, this uses the
+                                Tensor Cores of Volta and newer GPUs
+    @param accumulation_steps   The amount of batches whose gradients are summed
+                                up before they are applied
+    @param shared_trunk         Use a single feature extractor with a small head per
+                                characteristic instead of four separate networks
+    @param decay_steps          The amount of training steps to decay the learning rate over
+    @param jit_compile          Compile the whole training step with XLA
+    """
+    if mixed_precision:
+        tf.keras.mixed_precision.set_global_policy("mixed_float16")
+        tf.config.optimizer.set_jit(True)
+
+    input_shape = (img_height, img_width, 3)
+    inputs = Input(shape=input_shape, name="input")
+
+    # The rescaling is the same for all branches, it is done once and shared
+    rescaled = layers.experimental.preprocessing.Rescaling(1./255)(inputs)
+
+    if shared_trunk:
+        features = build_shared_trunk(rescaled)
+        pollen_m = build_head(features, "pollen")
+        varroa_m = build_head(features, "varroa")
+        wasps_m = build_head(features, "wasps")
+        cooling_m = build_head(features, "cooling")
+    else:
+        pollen_m = build_pollen_branch(rescaled)
+        varroa_m = build_varroa_branch(rescaled)
+        wasps_m = build_wasps_branch(rescaled)
+        cooling_m = build_cooling_branch(rescaled)
+
+    model = AccumulatingModel(
+        inputs=inputs,
+        outputs=[varroa_m, pollen_m, wasps_m, cooling_m],
+        name="beenet",
+        accumulation_steps=accumulation_steps)
+
+    compile_bee_model(model, mixed_precision=mixed_precision, decay_steps=decay_steps, jit_compile=jit_compile)
+
     return model
+
+def fold_batch_norms(model):
+    """! Creates a copy of the trained model for inference, where the BatchNormalizations
+         are folded into the weights of the adjacent layer. This applies to a normalization
+         directly behind a Conv2D and to one between a Flatten and a Dense layer.
+         In inference the normalization is a fixed scale and shift per channel, so it can be
+         merged into the kernel and bias of that layer, which saves one pass over the data
+    @param model    The trained BeeModel
+    @return The folded model with the same inputs and outputs
+    """
+    # Find the normalizations to fold and compute the merged weights
+    folded = {}
+    for bn in model.layers:
+        if not isinstance(bn, BatchNormalization) or len(bn.outbound_nodes) != 1:
+            continue
+        gamma, beta, mean, var = bn.get_weights()
+        scale = gamma / np.sqrt(var + bn.epsilon)
+        shift = beta - mean * scale
+
+        prev_layer = bn.inbound_nodes[0].inbound_layers
+        next_layer = bn.outbound_nodes[0].outbound_layer
+        if isinstance(prev_layer, Conv2D) and len(prev_layer.outbound_nodes) == 1:
+            # Normalizes the output of the convolution: y = (x * k + b) * scale + shift
+            weights = prev_layer.get_weights()
+            bias = weights[1] if prev_layer.use_bias else np.zeros_like(shift)
+            folded[bn.name] = None
+            folded[prev_layer.name] = [weights[0] * scale, bias * scale + shift]
+        elif isinstance(prev_layer, Flatten) and isinstance(next_layer, Dense):
+            # Normalizes the input of the dense layer: y = (x * scale + shift) * k + b
+            kernel, bias = next_layer.get_weights()
+            folded[bn.name] = None
+            folded[next_layer.name] = [kernel * scale[:, None], bias + shift @ kernel]
+
+    # The folded normalizations are replaced by an identity and the
+    # convolutions get a bias, which takes the shift of the normalization
+    def clone_layer(layer):
+        config = layer.get_config()
+        if isinstance(layer, BatchNormalization) and layer.name in folded:
+            return Activation("linear", name=layer.name)
+        if isinstance(layer, Conv2D) and layer.name in folded:
+            config["use_bias"] = True
+        return layer.__class__.from_config(config)
+
+    inference = tf.keras.models.clone_model(model, clone_function=clone_layer)
+    for layer in model.layers:
+        if isinstance(layer, BatchNormalization) and layer.name in folded:
+            continue
+        weights = folded[layer.name] if layer.name in folded else layer.get_weights()
+        inference.get_layer(layer.name).set_weights(weights)
+
+    return inference
+
+def get_pruned_model(model, target_sparsity, end_step, learning_rate=0.0001, mixed_precision=False):
+    """! Creates a copy of the trained BeeModel for fine tuning, where the weights of the
+         convolutions with the smallest magnitude are gradually set to zero. The pruning
+         wrappers have to be removed with 'strip_pruning' once the fine tuning is done.
+         Requires the 'tensorflow_model_optimization' package
+    @param model            The trained BeeModel, not folded
+    @param target_sparsity  The fraction of the convolution weights to set to zero
+    @param end_step         The training step at which the target sparsity is reached
+    @param learning_rate    The learning rate to fine tune the model with
+    @param mixed_precision  Whether the model is trained with the mixed_float16 policy
+    @return The compiled model, it has to be trained with the 'UpdatePruningStep' callback
+    """
+    import tensorflow_model_optimization as tfmot
+
+    schedule = tfmot.sparsity.keras.PolynomialDecay(initial_sparsity=0.0,
+            final_sparsity=target_sparsity, begin_step=0, end_step=end_step)
+
+    def prune_layer(layer):
+        if isinstance(layer, Conv2D):
+            return tfmot.sparsity.keras.prune_low_magnitude(layer, pruning_schedule=schedule)
+        return layer
+
+    pruned_model = tf.keras.models.clone_model(model, clone_function=prune_layer)
+    compile_bee_model(pruned_model, learning_rate, mixed_precision)
+    return pruned_model
+
+def get_quantization_aware_model(model, learning_rate=0.0001):
+    """! Creates a quantization aware copy of the trained BeeModel, which simulates the
+         INT8 quantization during training, so the weights can adapt to it. The rescaling
+         of the input and the final Dense and sigmoid layers of each branch stay float.
+         Requires the 'tensorflow_model_optimization' package
+    @param model            The trained BeeModel, not folded
+    @param learning_rate    The learning rate to fine tune the model with
+    @return The compiled quantization aware model
+    """
+    import tensorflow_model_optimization as tfmot
+
+    def annotate_layer(layer):
+        if isinstance(layer, (Conv2D, BatchNormalization, MaxPooling2D, Flatten)):
+            return tfmot.quantization.keras.quantize_annotate_layer(layer)
+        if isinstance(layer, Activation) and layer.get_config()["activation"] == "relu":
+            return tfmot.quantization.keras.quantize_annotate_layer(layer)
+        return layer
+
+    annotated = tf.keras.models.clone_model(model, clone_function=annotate_layer)
+    qat_model = tfmot.quantization.keras.quantize_apply(annotated)
+    compile_bee_model(qat_model, learning_rate)
+    return qat_model
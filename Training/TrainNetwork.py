@@ -11,8 +11,8 @@
 #
 
 import argparse
-import tensorflow as tf
-import BeeModel
+import contextlib
+import os
 
 
 # Allow growth
@@ -27,7 +27,36 @@ parser.add_argument("--gpu", action="store_true",
                     help="Use --gpu=True to train network with GPU and nothing to train on CPU.")
 parser.add_argument("--local-ds", action="store_true",
                     help="Use --local-ds=True to use local BeeDataset files. Default is to use the dataset uploaded to tensorflow-datasets.")
+parser.add_argument("--mixed-precision", action="store_true",
+                    help="Use --mixed-precision to train with float16 on GPUs with Tensor Cores (Volta and newer).")
+parser.add_argument("--epochs", type=int, default=20,
+                    help="The amount of epochs to train the network.")
+parser.add_argument("--batch-size", type=int, default=11,
+                    help="The batch size, the default of 11 avoids running out of memory on the JetsonNano.")
+parser.add_argument("--accumulate", type=int, default=1,
+                    help="The amount of batches whose gradients are summed up before they are applied. Use it to train with a larger effective batch size on small devices.")
+parser.add_argument("--tflite", action="store_true",
+                    help="Use --tflite to also store an INT8 quantized TensorFlow Lite model, as used with NN_USE_TFLITE.")
+parser.add_argument("--qat-epochs", type=int, default=0,
+                    help="Fine tune the model for the given amount of epochs with quantization aware training before storing the TensorFlow Lite model. Requires tensorflow-model-optimization.")
+parser.add_argument("--prune-epochs", type=int, default=0,
+                    help="Fine tune the model for the given amount of epochs while pruning the convolution weights. Requires tensorflow-model-optimization.")
+parser.add_argument("--prune-sparsity", type=float, default=0.5,
+                    help="The fraction of the convolution weights that are set to zero by --prune-epochs.")
+parser.add_argument("--shared-trunk", action="store_true",
+                    help="Use --shared-trunk to train a single feature extractor with a small head per characteristic, instead of four separate networks.")
+parser.add_argument("--xla", action="store_true",
+                    help="Use --xla to compile the whole training step, including the optimizer, with XLA.")
+parser.add_argument("--cache-dir", default=None,
+                    help="Cache the decoded datasets in the given folder instead of keeping them in memory.")
 args = parser.parse_args()
+if args.qat_epochs and args.mixed_precision:
+    parser.error("--qat-epochs cannot be combined with --mixed-precision")
+
+# TensorFlow is imported after parsing the arguments, so the help is shown without delay
+import tensorflow as tf
+import tensorflow_datasets as tfds
+import BeeModel
 
 # Jetson Nano GPU
 if args.gpu:
@@ -37,44 +66,91 @@ if args.gpu:
     session = tf.compat.v1.InteractiveSession(config=config)
 
 MODEL_SAVE_PATH = "SavedModel"
+TFLITE_SAVE_PATH = "SavedModel.tflite"
 
 
-# Load via TFDS
+# Load via TFDS, importing the local dataset registers it instead of the published one
 if args.local_ds:
     from BeeDataset.bee_dataset import BeeDataset
-    train, val = tfds.load('bee_dataset/bee_dataset_150',
-                       batch_size=11,  # 100, #changed batch to load to Jetson Nano to avoid process kill
-                       as_supervised=True,
-                       split=["train[0%:50%]", "train[50%:100%]"])
-else:
-    import tensorflow_datasets as tfds
-    train, val = tfds.load('bee_dataset/bee_dataset_150',
-                       batch_size=11,  # 100, #changed batch to load to Jetson Nano to avoid process kill
-                       as_supervised=True,
-                       split=["train[0%:50%]", "train[50%:100%]"])
+train, val = tfds.load('bee_dataset/bee_dataset_150',
+                   batch_size=args.batch_size,
+                   as_supervised=True,
+                   split=["train[0%:50%]", "train[50%:100%]"])
 
-if args.gpu:
-    # Use GPU to train network
-    with tf.device('/GPU:0'):
-        # Get the BeeModel and train it
-        model = BeeModel.get_bee_model(150, 75)
-        model.fit(
-            train,
-            validation_data=val,
-            epochs=20,
-            verbose=1,
-            callbacks=[]
-        )
+# Keep the decoded images after the first epoch and prepare the next batches
+#  while the current one is trained. The images are kept in memory, unless a
+#  cache folder is given, e.g. on devices with little memory like the JetsonNano
+if args.cache_dir:
+    os.makedirs(args.cache_dir, exist_ok=True)
+    train = train.cache(os.path.join(args.cache_dir, "bee_train"))
+    val = val.cache(os.path.join(args.cache_dir, "bee_val"))
 else:
-    model = BeeModel.get_bee_model(150, 75)
+    train = train.cache()
+    val = val.cache()
+train = train.prefetch(tf.data.experimental.AUTOTUNE)
+val = val.prefetch(tf.data.experimental.AUTOTUNE)
+
+# The learning rate decays over all optimizer steps of the training
+decay_steps = int(tf.data.experimental.cardinality(train)) * args.epochs // args.accumulate
+
+# Get the BeeModel and train it, on the GPU if wanted
+with tf.device('/GPU:0') if args.gpu else contextlib.nullcontext():
+    model = BeeModel.get_bee_model(150, 75, mixed_precision=args.mixed_precision,
+            accumulation_steps=args.accumulate, shared_trunk=args.shared_trunk,
+            decay_steps=decay_steps, jit_compile=args.xla)
     model.fit(
         train,
         validation_data=val,
-        epochs=20,
+        epochs=args.epochs,
         verbose=1,
         callbacks=[]
     )
 
-# Save the model and show the summary
-model.save(MODEL_SAVE_PATH)
+# Prune the convolutions, the smallest weights are gradually set to zero while fine tuning
+if args.prune_epochs:
+    import tensorflow_model_optimization as tfmot
+    end_step = int(tf.data.experimental.cardinality(train)) * args.prune_epochs
+    pruned_model = BeeModel.get_pruned_model(model, args.prune_sparsity, end_step,
+            mixed_precision=args.mixed_precision)
+    pruned_model.fit(
+        train,
+        validation_data=val,
+        epochs=args.prune_epochs,
+        verbose=1,
+        callbacks=[tfmot.sparsity.keras.UpdatePruningStep()]
+    )
+    model = tfmot.sparsity.keras.strip_pruning(pruned_model)
+
+# Fold the normalizations that are only needed for training and save the model
 model.summary()
+inference_model = BeeModel.fold_batch_norms(model)
+inference_model.save(MODEL_SAVE_PATH)
+
+# Quantize the model to INT8. Either fine tune it with simulated quantization first,
+#  or use the training images to calibrate the value ranges of the saved model
+if args.qat_epochs:
+    qat_model = BeeModel.get_quantization_aware_model(model)
+    qat_model.fit(
+        train,
+        validation_data=val,
+        epochs=args.qat_epochs,
+        verbose=1,
+        callbacks=[]
+    )
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(qat_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    with open(TFLITE_SAVE_PATH, "wb") as f:
+        f.write(converter.convert())
+
+elif args.tflite:
+    def representative_dataset():
+        for images, _ in train.unbatch().batch(1).take(200):
+            yield [tf.cast(images, tf.float32)]
+
+    converter = tf.lite.TFLiteConverter.from_saved_model(MODEL_SAVE_PATH)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with open(TFLITE_SAVE_PATH, "wb") as f:
+        f.write(converter.convert())
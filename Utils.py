@@ -8,13 +8,17 @@
 # @section authors Author(s)
 # - Created by Fabian Hickert on december 2020
 #
+import os
 import math
-import imutils
+import logging
+import numpy as np
 import cv2
 import csv
 import yaml
 import argparse
 
+logger = logging.getLogger(__name__)
+
 _woman_names = None
 
 __cfg = None
@@ -42,11 +46,30 @@ def get_args():
     parser.add_argument("--video", help="Do not run on camera, use provided video file instead")
     return parser.parse_args()
 
+def set_realtime_priority(name):
+    """! Raises the scheduling priority of the calling process or thread, if configured in
+         'PROCESS_RT_PRIORITY'. SCHED_FIFO is used if permitted, otherwise the nice value
+         is lowered. Both require CAP_SYS_NICE or an entry in /etc/security/limits.conf
+    @param name  The name of the process or thread class in the configuration
+    """
+    prio = get_config("PROCESS_RT_PRIORITY").get(name)
+    if not prio or not hasattr(os, "sched_setscheduler"):
+        return
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(prio))
+        logger.debug("%s runs with real-time priority %i", name, prio)
+    except PermissionError:
+        try:
+            os.nice(-10)
+            logger.debug("%s runs with nice value -10", name)
+        except PermissionError:
+            logger.warning("Not permitted to raise the priority of %s", name)
+
 def loadWomanNames():
     """! Loads the bee names from 'Namen/Namen.list' and returns them as list
     """
     global _woman_names
-    if type(_woman_names) == type(None):
+    if _woman_names is None:
         _woman_names = []
         with open('Names/Vornamen_2018_Koeln.csv', encoding="utf8", errors="ignore") as _file:
             _woman_names = _file.readlines()
@@ -59,11 +82,30 @@ def loadWomanNames():
     _woman_names = list(_woman_names)
     return _woman_names
 
+__extract_size = None
+def get_extract_size():
+    """! Returns the size (width, height) of the extracted bee images
+    @return  tuple  (width, height)
+    """
+    global __extract_size
+    if __extract_size is None:
+        if get_config("NN_EXTRACT_RESOLUTION") == "EXT_RES_150x300":
+            __extract_size = (150, 300)
+        elif get_config("NN_EXTRACT_RESOLUTION") == "EXT_RES_75x150":
+            __extract_size = (75, 150)
+        else:
+            raise BaseException("Unknown setting for NN_EXTRACT_RESOLUTION, expected EXT_RES_150x300 or EXT_RES_75x150")
+    return __extract_size
+
 def variance_of_laplacian(image):
     """! Compute the Laplacian of the image and returns a numeric value
     representing the sharpness of the image
     """
-    return cv2.Laplacian(image, cv2.CV_64F).var()
+    # The Laplacian of an 8 bit image fits into 16 bit. The variance over all channels
+    # is derived from the mean and deviation of each channel, as they are equal in size
+    lap = cv2.Laplacian(image, cv2.CV_16S)
+    mean, stddev = cv2.meanStdDev(lap)
+    return float(np.mean(stddev*stddev + mean*mean) - np.mean(mean)**2)
 
 def cutEllipseFromImage(el, img, pad, scale=1):
     """! Cuts an ellipse from an given image and rotates it to 0 degree.
@@ -82,70 +124,54 @@ def cutEllipseFromImage(el, img, pad, scale=1):
     angle = el[4]
 
     # Get desired width/height
-    w = h = 0
-    if get_config("NN_EXTRACT_RESOLUTION") == "EXT_RES_150x300":
-        w = 150
-        h = 300
-    elif get_config("NN_EXTRACT_RESOLUTION") == "EXT_RES_75x150":
-        w = 75
-        h = 150
-    else:
-        raise("Unknown setting for EXT_RES_75x150, expected EXT_RES_150x300 or EXT_RES_75x150")
+    w, h = get_extract_size()
 
     # Calcuate the size of an image the covers the rotated ellipse
     ga = (math.pi) / 180 * angle
-    xb = int(math.sqrt(
-            math.pow(w,2)*math.pow(math.cos(ga),2)+
-            math.pow(h,2)*math.pow(math.sin(ga),2)
-            ))
-    yb = int(math.sqrt(
-            math.pow(w,2)*math.pow(math.sin(ga),2)+
-            math.pow(h,2)*math.pow(math.cos(ga),2)
-            ))
+    cos_a = math.cos(ga)
+    sin_a = math.sin(ga)
+    xb = int(math.sqrt(w*w*cos_a*cos_a + h*h*sin_a*sin_a))
+    yb = int(math.sqrt(w*w*sin_a*sin_a + h*h*cos_a*cos_a))
 
     # Calculate the resulting coordinates if the above
     # rectangle gets applied to the actual image
     pc_1 =  (int(x-(xb/2)), int(y-(yb/2)))
     pc_2 =  (int(x+(xb/2)), int(y+(yb/2)))
-    pc_1a = (int(x-xb), int(y-yb))
-    pc_2a = (int(x+xb), int(y+yb))
 
-    # Return None, if we are out of image borders
-    if pc_1[0] < 0 or pc_1[0] > img.shape[1]:
-        return None, None
-    if pc_2[0] < 0 or pc_2[0] > img.shape[1]:
-        return None, None
-    if pc_1[1] < 0 or pc_1[1] > img.shape[0]:
-        return None, None
-    if pc_2[1] < 0 or pc_2[1] > img.shape[0]:
+    # Return None, if we are out of image borders. The first corner is
+    # always the upper left one, so each border needs a single test
+    img_h, img_w = img.shape[0:2]
+    if pc_1[0] < 0 or pc_1[1] < 0 or pc_2[0] > img_w or pc_2[1] > img_h:
         return None, None
 
-    # Try to crop the original image to the calculated rectangle size
-    # that covers the rotated ellipse and then rotate it back to 0 degrees
-    try:
-        crop_img1 = img[pc_1a[1]:pc_2a[1], pc_1a[0]:pc_2a[0]].copy()
-        crop_img2 = imutils.rotate_bound(crop_img1, -angle)
-
-        crop_value = 0.4
-        s0 = int((crop_img2.shape[0] -h + crop_value * h) / 2)
-        s1 = int((crop_img2.shape[1] -w + crop_value * w) / 2)
-    except:
-        return None, None
+    # Size of the image that results when rotating the rectangle (2*xb, 2*yb) back to 0 degrees,
+    # the desired image and the region for the sharpness test are cut from its center
+    cos_a = abs(cos_a)
+    sin_a = abs(sin_a)
+    nW = int(2*yb*sin_a + 2*xb*cos_a)
+    nH = int(2*yb*cos_a + 2*xb*sin_a)
+    s0 = int((nH - h) / 2)
+    s1 = int((nW - w) / 2)
+
+    # Rotate the image around the ellipse center back to 0 degrees and move it into
+    # the desired image. A single warp directly produces the result, without cutting
+    # and rotating a larger intermediate image
+    M = cv2.getRotationMatrix2D((x, y), angle, 1.0)
+    M[0, 2] += nW / 2 - s1 - x
+    M[1, 2] += nH / 2 - s0 - y
+    crop_img = cv2.warpAffine(img, M, (w, h))
 
     # Get the center of the resulting iamge to perform sharpness tests
-    crop_cnt = crop_img2[s0:crop_img2.shape[0]-s0, s1:crop_img2.shape[1]-s1]
+    crop_value = 0.4
+    c0 = int((nH - h + crop_value * h) / 2) - s0
+    c1 = int((nW - w + crop_value * w) / 2) - s1
+    crop_cnt = crop_img[c0:nH-2*s0-c0, c1:nW-2*s1-c1]
     crop_cnt = cv2.resize(crop_cnt, (45, 90))
 
     # Calculate a numeric value representing the image sharpness
     v = variance_of_laplacian(crop_cnt)
 
-    # Crop the image to the desired size
-    s0 = int((crop_img2.shape[0] -h)/2)
-    s1 = int((crop_img2.shape[1] -w)/2)
-    crop_img3 = crop_img2[s0:crop_img2.shape[0]-s0, s1:crop_img2.shape[1]-s1]
-    crop_img3 = crop_img3[0:h, 0:w]
-
-    return crop_img3, v
+    return crop_img, v
 
 
 # All credits to Ajasja from stackoverflow!
@@ -180,6 +206,36 @@ def pointInEllipse(p, e):
     return  res <= 1
 
 
+def pointsInEllipses(points, ellipses):
+    """! Vectorized version of 'pointInEllipse', tests all points against all ellipses
+    @param points       Array like of shape (N, 2) containing [x,y] coordinates
+    @param ellipses     List of ellipses ((x, y), (w, h), angle)
+    @return A boolean array of shape (N, M), True where point n is inside of ellipse m
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(ellipses) == 0:
+        return np.zeros((len(points), 0), dtype=bool)
+
+    e = np.array([(c[0], c[1], a[0], a[1], angle) for c, a, angle in ellipses], dtype=np.float64)
+
+    # Radii, angle and pre calculated cos/sin of the ellipses
+    rex = e[:, 2] / 2
+    rey = e[:, 3] / 2
+    angle = e[:, 4] / 180 * math.pi
+    cos_a = np.cos(angle)
+    sin_a = np.sin(angle)
+
+    # Distance of each point to each ellipse center
+    dx = points[:, 0, None] - e[None, :, 0]
+    dy = points[:, 1, None] - e[None, :, 1]
+
+    # Values <= 1 are inside of the ellipse
+    t1 = cos_a*dx + sin_a*dy
+    t2 = sin_a*dx - cos_a*dy
+    res = ((t1*t1)/(rex*rex)) + ((t2*t2)/(rey * rey))
+    return res <= 1
+
+
 def get_frame_config():
     """! Returns a configuration for the image provider on how
          to prepare and provide the captured frames
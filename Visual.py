@@ -10,13 +10,13 @@
 import time
 import logging
 import cv2
-import multiprocessing
 import datetime
 import queue
+import numpy as np
 from Utils import get_config, get_args
 from BeeTracking import BeeTracker, BeeTrack
-from multiprocessing import Queue
 from BeeProcess import BeeProcess
+from SharedImageQueue import SharedImageQueue
 
 logger = logging.getLogger(__name__)
 
@@ -29,12 +29,18 @@ class Visual(BeeProcess):
         """! Initializes the visualiser
         """
         super().__init__()
-        self._inQueue = multiprocessing.Queue(maxsize=20)
+        self._inQueue = SharedImageQueue(maxsize=2, shape=(540, 960, 3), image_index=0)
         self.set_process_param("in_q", self._inQueue)
 
+    def stop(self):
+        """! Stops the process and releases the shared memory of the incoming queue
+        """
+        super().stop()
+        self._inQueue.unlink()
+
     def getInQueue(self):
         """! Sets the input queue to receive the current image and the tracking results
-             (img_540, detected_bees, detected_bee_groups, tracker)
+             (img_540, detected_bees, detected_bee_groups, tracker snapshot, process FPS)
         """
         return self._inQueue 
 
@@ -49,73 +55,95 @@ class Visual(BeeProcess):
         _process_time_n100 = time.time()
         _lastFPS = 0
 
+        # The frame is copied out of the queue into this buffer, instead of
+        # allocating a new one for every frame
+        frame = np.empty((540, 960, 3), dtype=np.uint8)
+        writer = None
+
+        # The configuration doesn't change while running, read it once
+        show_details = get_config("SHOW_VISUALIZATION_DETAILS")
+        frame_skip = get_config("VISUALIZATION_FRAME_SKIP")
+        draw_ellipses = get_config("DRAW_DETECTED_ELLIPSES")
+        draw_groups = get_config("DRAW_DETECTED_GROUPS")
+        draw_tracks = get_config("DRAW_TRACKING_RESULTS")
+        show_preview = not get_args().noPreview
+        skipKey = 1 if get_config("FRAME_AUTO_PROCESS") else 0
+        save_video = get_config("SAVE_AS_VIDEO")
+
         while stopped.value == 0:
-            if not in_q.empty():
-
-                _start_t = time.time()
-               
-                # Log FPS
-                if _process_cnt != 0 and _process_cnt % 100 == 0:
-                    fps = (100/ (time.time() - _process_time_n100))
-                    _lastFPS = fps
-                    _process_time_n100 = time.time()
-                    logger.info(f"FPS visual: {fps:.2f} FPS")
-
-                _process_cnt += 1
-
-                # Read one entry from the process queue
-                img_540, detected_bees, detected_bee_groups, tracker, processFPS = in_q.get()
-
-                if get_config("SHOW_VISUALIZATION_DETAILS"):
-                    cv2.putText(img_540,"Process FPS: %.2f" % (processFPS,), 
-                        (img_540.shape[1]-200,20),
-                        cv2.FONT_HERSHEY_PLAIN, 1, (0,0,255), 1)
-                    cv2.putText(img_540,"Visual FPS: %.2f" % (_lastFPS), 
-                        (img_540.shape[1]-200,40),
-                        cv2.FONT_HERSHEY_PLAIN, 1, (0,0,255), 1)
-                    cv2.putText(img_540,"Frame Skip: %i" % (get_config("VISUALIZATION_FRAME_SKIP"),), 
-                        (img_540.shape[1]-200,60),
-                        cv2.FONT_HERSHEY_PLAIN, 1, (0,0,255), 1)
-
-                if get_config("DRAW_DETECTED_ELLIPSES"):
-                    for item in detected_bees:
-                        cv2.ellipse(img_540, item, (0, 0, 255), 2)
-                if get_config("DRAW_DETECTED_GROUPS"):
-                    for item in detected_bee_groups:
-                        cv2.ellipse(img_540, item, (255, 0, 0), 2)
-
-                if get_config("DRAW_TRACKING_RESULTS"):
-                    tracker.drawTracks(img_540)
-
-                # Draw preview if wanted
-                if not get_args().noPreview:
-
-                    skipKey = 1 if get_config("FRAME_AUTO_PROCESS") else 0
-
-                    cv2.imshow("frame", img_540)
-                    if cv2.waitKey(skipKey) & 0xFF == ord('q'):
-                        break
-
-                # Save as Video
-                if get_config("SAVE_AS_VIDEO"):
-                    if type(writer) == type(None):
-                        h, w, c = img_540.shape
-
-                        #TODO: Set real Framerate from video input or from video stream
+
+            # Wait for the next entry of the process queue
+            try:
+                img_540, detected_bees, detected_bee_groups, tracker, processFPS = in_q.get(timeout=0.1, out=frame)
+            except queue.Empty:
+                continue
+
+            _start_t = time.time()
+           
+            # Log FPS
+            if _process_cnt != 0 and _process_cnt % 100 == 0:
+                fps = (100/ (time.time() - _process_time_n100))
+                _lastFPS = fps
+                _process_time_n100 = time.time()
+                logger.info(f"FPS visual: {fps:.2f} FPS")
+
+            _process_cnt += 1
+
+            if show_details:
+                cv2.putText(img_540,"Process FPS: %.2f" % (processFPS,), 
+                    (img_540.shape[1]-200,20),
+                    cv2.FONT_HERSHEY_PLAIN, 1, (0,0,255), 1)
+                cv2.putText(img_540,"Visual FPS: %.2f" % (_lastFPS), 
+                    (img_540.shape[1]-200,40),
+                    cv2.FONT_HERSHEY_PLAIN, 1, (0,0,255), 1)
+                cv2.putText(img_540,"Frame Skip: %i" % (frame_skip,), 
+                    (img_540.shape[1]-200,60),
+                    cv2.FONT_HERSHEY_PLAIN, 1, (0,0,255), 1)
+
+            if draw_ellipses:
+                for item in detected_bees:
+                    cv2.ellipse(img_540, item, (0, 0, 255), 2)
+            if draw_groups:
+                for item in detected_bee_groups:
+                    cv2.ellipse(img_540, item, (255, 0, 0), 2)
+
+            if draw_tracks:
+                tracker.drawTracks(img_540)
+
+            # Draw preview if wanted
+            if show_preview:
+                cv2.imshow("frame", img_540)
+                if cv2.waitKey(skipKey) & 0xFF == ord('q'):
+                    break
+
+            # Save as Video
+            if save_video:
+                if writer is None:
+                    h, w, c = img_540.shape
+
+                    #TODO: Set real Framerate from video input or from video stream
+                    if get_config("SAVE_AS_VIDEO_USE_GSTREAM"):
+                        writer = cv2.VideoWriter('appsrc ! video/x-raw,format=BGR ! queue \
+                                    ! videoconvert ! video/x-raw,format=BGRx ! nvvidconv \
+                                    ! {} ! h264parse ! matroskamux \
+                                    ! filesink location={}'.format(get_config("SAVE_AS_VIDEO_GSTREAM_ENCODER"),
+                                                                   get_config("SAVE_AS_VIDEO_PATH")),
+                                    cv2.CAP_GSTREAMER, 0, 18, (w, h))
+                    else:
                         writer = cv2.VideoWriter(get_config("SAVE_AS_VIDEO_PATH"), \
                                 cv2.VideoWriter_fourcc(*'MJPG'), 18, (w, h))
-                    writer.write(img_540)
-                
+                writer.write(img_540)
+            
 
-                _process_time += time.time() - _start_t
+            _process_time += time.time() - _start_t
 
-                # Print log entry about process time each 100 frames
-                if _process_cnt % 100 == 0:
-                    logger.debug("Process time: %0.3fms" % (_process_time * 10.0))
-                    _process_time = 0
+            # Print log entry about process time each 100 frames
+            if _process_cnt % 100 == 0:
+                logger.debug("Process time: %0.3fms" % (_process_time * 10.0))
+                _process_time = 0
 
-            else:
-                time.sleep(0.01)
+        if writer is not None:
+            writer.release()
 
         # The process stopped
         logger.info("Image extractor stopped")
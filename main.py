@@ -2,17 +2,26 @@
 from ImageProvider import ImageProvider
 from ImageConsumer import ImageConsumer
 from ImageExtractor import ImageExtractor
-from LoRaWANThread import LoRaWANThread
-from Visual import Visual
 from Utils import get_args, get_config
 import logging
-import time
 import sys
+import multiprocessing.connection
+
+# The optional parts are read once, so the imports and the created processes always match
+nn_enabled = get_config("NN_ENABLE")
+visualization_enabled = get_config("VISUALIZATION_ENABLED")
+lorawan_enabled = get_config("RN2483A_LORA_ENABLE")
 
 # Only load neural network if needed. the overhead is quite large
-if get_config("NN_ENABLE"):
+if nn_enabled:
     from BeeClassification import BeeClassification
 
+# The same applies to the visualisation and the LoRaWAN sender, which needs pyserial
+if visualization_enabled:
+    from Visual import Visual
+if lorawan_enabled:
+    from LoRaWANThread import LoRaWANThread
+
 logging.basicConfig(level=logging.DEBUG, format='%(process)d %(asctime)s - %(name)s - %(levelname)s - \t%(message)s')
 logger = logging.getLogger(__name__)
 
@@ -27,64 +36,62 @@ def main():
         logger.info("Starting on camera input")
         imgProvider = ImageProvider(video_source=0)
 
-    while(not (imgProvider.isStarted() or imgProvider.isDone())):
-        time.sleep(1)
-
-    if imgProvider.isDone():
+    # Wait for the video input to be opened
+    if not imgProvider.waitReady(get_config("CAMERA_INIT_TIMEOUT")):
         logger.error("Aborted, ImageProvider did not start. Please see log for errors!")
+        imgProvider.stop()
         return
 
     # Enable bee classification process only when its enabled
     imgClassifier = None
-    if get_config("NN_ENABLE"):
+    if nn_enabled:
         imgClassifier = BeeClassification()
 
     # Create processes and connect message queues between them
     lorawan = None
-    if get_config("RN2483A_LORA_ENABLE"):
+    if lorawan_enabled:
         lorawan = LoRaWANThread()
     imgExtractor = ImageExtractor()
     imgConsumer = ImageConsumer()
-    visualiser = Visual()
+    visualiser = None
+    if visualization_enabled:
+        visualiser = Visual()
     imgConsumer.setImageQueue(imgProvider.getQueue())
-    imgConsumer.setVisualQueue(visualiser.getInQueue())
-    if get_config("NN_ENABLE"):
+    if visualiser is not None:
+        imgConsumer.setVisualQueue(visualiser.getInQueue())
+    if nn_enabled:
         imgExtractor.setResultQueue(imgClassifier.getQueue())
         imgConsumer.setClassifierResultQueue(imgClassifier.getResultQueue())
     imgExtractor.setInQueue(imgConsumer.getPositionQueue())
+    processes = [proc for proc in (imgProvider, imgExtractor, visualiser, imgConsumer, imgClassifier)
+                 if proc is not None]
 
     try:
 
         # Start the processes
         imgConsumer.start()
         imgExtractor.start()
-        visualiser.start()
+        if visualiser is not None:
+            visualiser.start()
         if lorawan is not None:
             lorawan.start()
 
-        # Quit program if end of video-file is reached or
-        # the camera got disconnected
-        #imgConsumer.join()
-        while True:
-            time.sleep(0.01)
-            if imgConsumer.isDone() or imgProvider.isDone():
-                raise SystemExit(0)
+        # Quit program if end of video-file is reached, the camera got
+        # disconnected or any other process ended, e.g. by crashing.
+        # This blocks until one of the processes ended, without polling their state
+        multiprocessing.connection.wait([proc.getSentinel() for proc in processes])
+        raise SystemExit(0)
 
     except (KeyboardInterrupt, SystemExit):
 
-        # Tear down all running process to ensure that we don't get any zombies
+        # Tear down all running process to ensure that we don't get any zombies.
+        # All processes are signaled first, so they shut down at the same time
         if lorawan is not None:
             lorawan.stop()
-        imgProvider.stop()
-        imgExtractor.stop()
-        visualiser.stop()
-        imgConsumer.stop()
-        if imgClassifier:
-            imgClassifier.stop()
-            imgClassifier.join()
-        imgExtractor.join()
-        imgProvider.join()
-        visualiser.join()
+        for proc in processes:
+            proc.requestStop()
+        for proc in processes:
+            proc.stop()
 
 if __name__ == '__main__':
     main()